@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import TeamStrength
+from ModelArtifact import data_hash
+from Prediction import score_matrix, result_probabilities
+
+# A gap this long between consecutive matches starts a new season.
+SEASON_GAP_DAYS = 35
+
+
+def split_seasons(match_data, season_col='Season'):
+    """
+    :return: Array with a season label per match, from season_col if the data has it, otherwise a new season
+             starts after every break of more than SEASON_GAP_DAYS.
+    """
+    if season_col in match_data:
+        return match_data[season_col].values
+    dates = pd.to_datetime(match_data['Date'])
+    order = np.argsort(dates.values, kind='stable')
+    gaps = np.diff(dates.values[order]).astype('timedelta64[D]').astype(int) > SEASON_GAP_DAYS
+    labels = np.empty(len(match_data), dtype=int)
+    labels[order] = np.concatenate([[0], np.cumsum(gaps)])
+    return labels
+
+
+def gameweeks(season_matches):
+    """
+    :return: Gameweek number per match, counted in weeks from the first match of the season.
+    """
+    dates = pd.to_datetime(season_matches['Date'])
+    return ((dates - dates.min()).dt.days // 7).values
+
+
+def outcomes(matches, goals=('HG', 'AG')):
+    """
+    :return: Result per match, 0 home win, 1 draw, 2 away win. Uses the goal columns if the data has them and
+             rounded xG otherwise.
+    """
+    if goals[0] in matches and goals[1] in matches:
+        home, away = matches[goals[0]].values, matches[goals[1]].values
+    else:
+        home, away = matches['xG'].round().values, matches['xGA'].round().values
+    return np.where(home > away, 0, np.where(home == away, 1, 2))
+
+
+def predict_matches(parameters, matches):
+    """
+    Result probabilities of matches under fitted parameters. Teams the fit has not seen yet (e.g. promoted teams)
+    get the average strength.
+
+    :return: DataFrame with the matches, lamb, mu and p_home, p_draw and p_away.
+    """
+    team_parameters = parameters[2]
+    mean_a = np.mean([team_parameters[team]['a'] for team in team_parameters])
+    mean_b = np.mean([team_parameters[team]['b'] for team in team_parameters])
+
+    def strength(team, key, default):
+        return team_parameters[team][key] if team in team_parameters else default
+
+    a_h = np.array([strength(team, 'a', mean_a) for team in matches['H']])
+    b_h = np.array([strength(team, 'b', mean_b) for team in matches['H']])
+    a_a = np.array([strength(team, 'a', mean_a) for team in matches['A']])
+    b_a = np.array([strength(team, 'b', mean_b) for team in matches['A']])
+
+    lamb, mu = a_h * b_a * parameters[0], a_a * b_h
+    p_home, p_draw, p_away = result_probabilities(score_matrix(lamb, mu, parameters[1]))
+    predictions = matches[['Date', 'H', 'A']].copy()
+    predictions['lamb'], predictions['mu'] = lamb, mu
+    predictions['p_home'], predictions['p_draw'], predictions['p_away'] = p_home, p_draw, p_away
+    return predictions
+
+
+def backtest_season(history, season, max_steps=300, warm_steps=50, learning_rate=0.003):
+    """
+    Replays one season gameweek by gameweek: fit on everything before the gameweek, predict the gameweek, move on.
+    The first fit is cold, every later one warm starts from the previous fit and only takes warm_steps steps.
+
+    :param history: Matches before the season.
+    :param season: Matches of the season.
+    :return: DataFrame of predictions, with gameweek and outcome columns.
+    """
+    season = season.assign(GW=gameweeks(season))
+    parameters = None
+    predictions = []
+    for gw in np.unique(season['GW']):
+        train = pd.concat([history, season.loc[season['GW'] < gw]], ignore_index=True)
+        target = season.loc[season['GW'] == gw]
+        if len(train) == 0:
+            continue
+        today = pd.to_datetime(target['Date']).min()
+        parameters = TeamStrength.maximize(train, max_steps=max_steps if parameters is None else warm_steps,
+                                           learning_rate=learning_rate, initial=parameters, today=today)
+        gw_predictions = predict_matches(parameters, target)
+        gw_predictions['GW'] = gw
+        gw_predictions['Outcome'] = outcomes(target)
+        predictions.append(gw_predictions)
+    return pd.concat(predictions, ignore_index=True)
+
+
+def _run_season(job):
+    history, season, label, hyperparameters, path = job
+    start = time.perf_counter()
+    predictions = backtest_season(history, season, **hyperparameters)
+    predictions.insert(0, 'Season', label)
+    if path is not None:
+        predictions.to_csv(path, index=False)
+    return predictions, time.perf_counter() - start
+
+
+def run_backtest(match_data, seasons=None, history_seasons=2, workers=None, cache_dir='backtest_cache',
+                 **hyperparameters):
+    """
+    Walk-forward backtest over several seasons. Seasons are independent and run in parallel, and the per-GW
+    predictions of every season are cached, keyed by the data the season sees and the hyperparameters, so scoring
+    with a new metric never refits.
+
+    :param match_data: DataFrame in the data.csv format, with HG and AG columns for scoring if available.
+    :param seasons: Season labels to backtest, defaults to every season with enough history before it.
+    :param history_seasons: Number of earlier seasons each season is fitted on.
+    :param workers: Number of processes.
+    :param cache_dir: Where predictions are cached, None to disable the cache.
+    :param hyperparameters: Passed on to backtest_season.
+    :return: DataFrame of all predictions.
+    """
+    labels = split_seasons(match_data)
+    ordered = list(pd.unique(labels[np.argsort(pd.to_datetime(match_data['Date']).values, kind='stable')]))
+    if seasons is None:
+        seasons = ordered[history_seasons:]
+
+    jobs, cached = [], []
+    for label in seasons:
+        k = ordered.index(label)
+        history = match_data.loc[np.isin(labels, ordered[max(k - history_seasons, 0):k])]
+        season = match_data.loc[labels == label]
+
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha256(json.dumps({
+                'history': data_hash(history), 'season': data_hash(season), 'outcomes': outcomes(season).tolist(),
+                'hyperparameters': hyperparameters
+            }, sort_keys=True).encode()).hexdigest()[:24]
+            path = os.path.join(cache_dir, f"{key}.csv")
+            if os.path.exists(path):
+                cached.append(pd.read_csv(path))
+                continue
+            os.makedirs(cache_dir, exist_ok=True)
+        jobs.append((history, season, label, hyperparameters, path))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for predictions, seconds in pool.map(_run_season, jobs):
+            print(f"Season {predictions['Season'].iloc[0]}: {len(predictions)} matches in {seconds:.1f} s")
+            cached.append(predictions)
+    return pd.concat(cached, ignore_index=True)
+
+
+def log_loss(probabilities, outcome):
+    return -np.log(np.clip(probabilities[np.arange(len(outcome)), outcome], 1e-15, 1))
+
+
+def brier(probabilities, outcome):
+    return ((probabilities - np.eye(3)[outcome])**2).sum(axis=1)
+
+
+def rps(probabilities, outcome):
+    """
+    Ranked probability score, treating home win, draw and away win as ordered.
+    """
+    cumulative = np.cumsum(probabilities, axis=1)[:, :2]
+    observed = np.cumsum(np.eye(3)[outcome], axis=1)[:, :2]
+    return ((cumulative - observed)**2).sum(axis=1) / 2
+
+
+METRICS = {'log_loss': log_loss, 'rps': rps, 'brier': brier}
+
+
+def score_predictions(predictions, metrics=METRICS):
+    """
+    :return: DataFrame with the mean of every metric per season, and over all seasons.
+    """
+    probabilities = predictions[['p_home', 'p_draw', 'p_away']].values
+    probabilities = probabilities / probabilities.sum(axis=1, keepdims=True)
+    outcome = predictions['Outcome'].values.astype(int)
+    scores = predictions[['Season']].copy()
+    for name, metric in metrics.items():
+        scores[name] = metric(probabilities, outcome)
+    table = scores.groupby('Season').mean()
+    table.loc['All'] = scores.drop(columns='Season').mean()
+    table['matches'] = list(scores.groupby('Season').size()) + [len(scores)]
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Walk-forward backtest of the strength model.")
+    parser.add_argument('data', nargs='?', default='data.csv', help="Match data in the data.csv format.")
+    parser.add_argument('--history-seasons', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=300)
+    parser.add_argument('--warm-steps', type=int, default=50)
+    parser.add_argument('--learning-rate', type=float, default=0.003)
+    parser.add_argument('--cache-dir', default='backtest_cache')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    predictions = run_backtest(pd.read_csv(args.data), history_seasons=args.history_seasons, workers=args.workers,
+                               cache_dir=args.cache_dir, max_steps=args.max_steps, warm_steps=args.warm_steps,
+                               learning_rate=args.learning_rate)
+    print(score_predictions(predictions))
+    print(f"Backtest took {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,322 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+import TeamStrength
+import Simulation
+import Kernels
+import InPlay
+from ModelArtifact import ratings_table
+
+# (teams, seasons) combinations we time at. maximize is the slow one, so it only runs a few steps per scale point.
+SCALE_POINTS = [(10, 1), (20, 1), (20, 3)]
+
+
+def generate_league(n_teams=20, n_seasons=1, seed=0, gamma=1.25, rho=0.1, end_date=None):
+    """
+    Synthetic league with known parameters, in the same format as data.csv.
+
+    Every season is a double round robin played one round a week, the last round on end_date. xG is drawn from a
+    gamma distribution with the model's expected goals as its mean, and actual goals from a Poisson distribution.
+
+    :param n_teams: Number of teams, must be even.
+    :param n_seasons: Number of seasons of played matches.
+    :param seed: Seed for the generator.
+    :param gamma: True home field advantage.
+    :param rho: True low score dependence, stored only, xG is continuous so it never applies.
+    :param end_date: Date of the last played round, defaults to today.
+    :return: Dict with 'matches' (played), 'fixtures' (one more season, unplayed), 'gws' (its deadlines) and
+             'truth' ([gamma, rho, {team: {'a', 'b'}}]).
+    """
+    if n_teams < 2 or n_teams % 2:
+        # The circle method pairs every team every round, with an odd number one team would play itself.
+        raise ValueError(f"n_teams must be even and at least 2, got {n_teams}")
+    rng = np.random.default_rng(seed)
+    end_date = datetime.today() if end_date is None else end_date
+
+    teams = [f"Team {i + 1}" for i in range(n_teams)]
+    a = np.exp(rng.normal(0, 0.25, n_teams)) * 1.2
+    b = np.exp(rng.normal(0, 0.2, n_teams))
+    truth = [gamma, rho, {team: {'a': a[i], 'b': b[i]} for i, team in enumerate(teams)}]
+
+    rounds = round_robin(n_teams)
+    rounds_per_season = len(rounds)
+
+    matches = []
+    for season in range(n_seasons + 1):
+        for r, pairs in enumerate(rounds):
+            week = (n_seasons - 1 - season) * (rounds_per_season + 10) + rounds_per_season - 1 - r
+            date = (end_date - timedelta(weeks=week)).strftime("%Y-%m-%d")
+            for i, j in pairs:
+                matches.append((season, date, teams[i], teams[j], a[i] * b[j] * gamma, a[j] * b[i]))
+    matches = pd.DataFrame(matches, columns=['Season', 'Date', 'H', 'A', 'lamb', 'mu'])
+
+    shape = 8
+    matches['xG'] = rng.gamma(shape, matches['lamb'] / shape).round(2)
+    matches['xGA'] = rng.gamma(shape, matches['mu'] / shape).round(2)
+    matches['HG'] = rng.poisson(matches['lamb'])
+    matches['AG'] = rng.poisson(matches['mu'])
+
+    played = matches.loc[matches['Season'] < n_seasons, ['Date', 'H', 'A', 'xG', 'xGA', 'HG', 'AG']]
+    fixtures = matches.loc[matches['Season'] == n_seasons, ['Date', 'H', 'A']]
+    gws = sorted(fixtures['Date'].unique())
+
+    return {'matches': played.reset_index(drop=True), 'fixtures': fixtures.reset_index(drop=True), 'gws': gws,
+            'truth': truth}
+
+
+def generate_joint(n_teams=2000, n_matches=50000, division_size=20, cup_share=0.05, seed=0, end_date=None):
+    """
+    Synthetic multi-division data for the joint model: teams are split into divisions of division_size whose
+    strength falls with the division number, most matches are within a division, and a cup_share of matches are
+    cup ties between any two teams. Dates are spread over the three years up to end_date.
+
+    :return: Dict with 'matches' (with a Comp column) and 'truth' (teams, a, b, and hfa per competition).
+    """
+    rng = np.random.default_rng(seed)
+    end_date = pd.Timestamp(datetime.today() if end_date is None else end_date).normalize()
+
+    teams = np.array([f"Team {i + 1}" for i in range(n_teams)])
+    division = np.arange(n_teams) // division_size
+    n_divisions = division.max() + 1
+    a = np.exp(rng.normal(0, 0.2, n_teams) - 0.04 * division) * 1.2
+    b = np.exp(rng.normal(0, 0.15, n_teams) + 0.04 * division)
+    hfa = {f"Division {d + 1}": 1.15 + 0.1 * rng.random() for d in range(n_divisions)}
+    hfa['Cup'] = 1.1
+
+    n_cup = int(n_matches * cup_share)
+    home = rng.integers(0, n_teams, n_matches)
+    # League matches: the away team is another team of the same division.
+    offset = rng.integers(1, division_size, n_matches)
+    away = division[home] * division_size + (home % division_size + offset) % division_size
+    away = np.minimum(away, n_teams - 1)
+    away[:n_cup] = (home[:n_cup] + rng.integers(1, n_teams, n_cup)) % n_teams
+    same = away == home
+    away[same] = (away[same] + 1) % n_teams
+
+    comp = np.array([f"Division {d + 1}" for d in division[home]], dtype=object)
+    comp[:n_cup] = 'Cup'
+    gamma = np.array([hfa[c] for c in comp])
+    lamb, mu = a[home] * b[away] * gamma, a[away] * b[home]
+
+    shape = 8
+    dates = end_date - pd.to_timedelta(rng.integers(0, 3 * 365, n_matches), unit='D')
+    matches = pd.DataFrame({
+        'Date': dates.strftime("%Y-%m-%d"), 'H': teams[home], 'A': teams[away], 'Comp': comp,
+        'xG': rng.gamma(shape, lamb / shape).round(2), 'xGA': rng.gamma(shape, mu / shape).round(2)
+    })
+    return {'matches': matches, 'truth': {'teams': list(teams), 'a': a, 'b': b, 'hfa': hfa}}
+
+
+def check_joint(n_teams=2000, n_matches=50000, seed=0):
+    """
+    Times the sparse joint fit and checks its expected goals against the ground truth.
+
+    :return: Result dict.
+    """
+    import JointModel
+
+    data = generate_joint(n_teams, n_matches, seed=seed)
+    fit = JointModel.fit_joint(data['matches'])
+
+    truth = data['truth']
+    index = {team: i for i, team in enumerate(fit.teams)}
+    order = np.array([index[team] for team in truth['teams']])
+    matches = data['matches']
+    home = matches['H'].map(index).values
+    away = matches['A'].map(index).values
+    true_home = {team: i for i, team in enumerate(truth['teams'])}
+    th, ta = matches['H'].map(true_home).values, matches['A'].map(true_home).values
+
+    fitted = fit.a[home] * fit.b[away] * matches['Comp'].map(fit.hfa).values
+    true = truth['a'][th] * truth['b'][ta] * matches['Comp'].map(truth['hfa']).values
+    error = np.abs(fitted / true - 1)
+
+    result = {'teams': n_teams, 'matches': n_matches, 'seconds': fit.seconds, 'iterations': fit.iterations,
+              'median_error': float(np.median(error)), 'max_error': float(error.max())}
+    print(f"Joint fit: {n_matches} matches x {n_teams} teams in {fit.seconds:.1f} s ({fit.iterations} iterations), "
+          f"median expected goals error {result['median_error']:.3f}")
+    return result
+
+
+def round_robin(n_teams):
+    """
+    Circle method double round robin.
+
+    :return: List of rounds, each a list of (home, away) index pairs.
+    """
+    order = list(range(n_teams))
+    rounds = []
+    for r in range(n_teams - 1):
+        pairs = [(order[k], order[n_teams - 1 - k]) for k in range(n_teams // 2)]
+        rounds.append([pair if r % 2 == 0 else pair[::-1] for pair in pairs])
+        order = [order[0]] + [order[-1]] + order[1:-1]
+    return rounds + [[pair[::-1] for pair in pairs] for pairs in rounds]
+
+
+def fixtures_by_team(fixtures):
+    """
+    Converts a fixture DataFrame to the dict format of FDR.get_fixtures.
+    """
+    by_team = {team: [] for team in sorted(set(fixtures['H']) | set(fixtures['A']))}
+    for date, home, away in fixtures[['Date', 'H', 'A']].itertuples(index=False):
+        by_team[home].append({'date': date, 'opponent': away, 'home': True})
+        by_team[away].append({'date': date, 'opponent': home, 'home': False})
+    return by_team
+
+
+def time_call(fn, repeat=3):
+    """
+    :return: Dict with the best and median wall time of fn over repeat calls.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+
+def run_benchmarks(scale_points=SCALE_POINTS, max_steps=5, n_sims=2000, repeat=3, seed=0):
+    """
+    Times the model and its consumers at every scale point.
+
+    :return: List of result dicts.
+    """
+    import FDR
+
+    results = []
+    for n_teams, n_seasons in scale_points:
+        league = generate_league(n_teams, n_seasons, seed=seed)
+        matches, truth = league['matches'], league['truth']
+        scale = {'teams': n_teams, 'seasons': n_seasons, 'matches': len(matches)}
+
+        cases = {
+            'log_likelihood': lambda: TeamStrength.log_likelihood(matches, truth),
+            'find_gradient_vector': lambda: TeamStrength.find_gradient_vector(matches, truth),
+            'maximize': lambda: TeamStrength.maximize(matches, max_steps=max_steps),
+            'fdr_matrix': lambda: FDR.expected_goals_matrix(fixtures_by_team(league['fixtures']),
+                                                            ratings_table(truth), league['gws']),
+            'simulate_season': lambda: Simulation.simulate_season(league['fixtures'], truth, n_sims=n_sims, seed=seed)
+        }
+        # One live round: every match of the first fixture round, mid-match.
+        first_round = league['fixtures'].loc[league['fixtures']['Date'] == league['gws'][0]]
+        lamb, mu = Simulation.fixture_rates(first_round, truth)
+        engine = InPlay.InPlayEngine()
+        live = (np.ones(len(lamb), dtype=int), np.zeros(len(lamb), dtype=int), np.full(len(lamb), 60.0))
+        cases['inplay_update'] = lambda: engine.update(lamb, mu, *live)
+
+        data = TeamStrength.encode_matches(matches)
+        for backend in Kernels.BACKENDS:
+            cases[f'kernel_{backend}'] = lambda backend=backend: Kernels.evaluate(data, truth, backend)
+        for name, fn in cases.items():
+            timing = time_call(fn, repeat=1 if name == 'maximize' else repeat)
+            results.append(dict(name=name, **scale, **timing))
+            print(f"{name:<22}{n_teams:>4} teams {len(matches):>6} matches {timing['best'] * 1000:12.1f} ms")
+    return results
+
+
+def expected_goals_pairs(parameters, teams):
+    """
+    Expected home goals for every ordered pair of teams. Unlike a and b on their own these do not depend on the
+    arbitrary scale the fit settles on, so they are what we compare.
+    """
+    gamma = parameters[0]
+    a = np.array([parameters[2][team]['a'] for team in teams], dtype=float)
+    b = np.array([parameters[2][team]['b'] for team in teams], dtype=float)
+    return gamma * np.outer(a, b)
+
+
+def check_recovery(n_teams=20, n_seasons=2, max_steps=300, learning_rate=0.003, seed=0, tolerance=0.15,
+                   reference=None):
+    """
+    Fits a synthetic league and checks the fitted expected goals against the ground truth, and against a reference
+    fit from an earlier run if one is given.
+
+    The learning rate is lower than maximize's default, since with a full season of recent (barely decayed) matches
+    plain gradient ascent at 0.01 overshoots on gamma and diverges.
+
+    :param tolerance: Largest allowed median relative error to the ground truth.
+    :param reference: Result dict of an earlier check_recovery run.
+    :return: Result dict with the errors and the fitted expected goals.
+    """
+    league = generate_league(n_teams, n_seasons, seed=seed)
+    teams = sorted(league['truth'][2])
+
+    start = time.perf_counter()
+    fitted = TeamStrength.maximize(league['matches'], max_steps=max_steps, learning_rate=learning_rate)
+    elapsed = time.perf_counter() - start
+
+    true_pairs = expected_goals_pairs(league['truth'], teams)
+    fitted_pairs = expected_goals_pairs(fitted, teams)
+    error = np.abs(fitted_pairs / true_pairs - 1)
+
+    result = {
+        'teams': n_teams, 'seasons': n_seasons, 'max_steps': max_steps, 'learning_rate': learning_rate, 'seed': seed,
+        'seconds': elapsed,
+        'median_error': float(np.median(error)), 'max_error': float(error.max()),
+        'passed': bool(np.median(error) < tolerance), 'expected_goals': fitted_pairs.round(10).tolist()
+    }
+    if reference is not None:
+        drift = np.abs(fitted_pairs - np.array(reference['expected_goals'])).max()
+        result['reference_drift'] = float(drift)
+        result['passed'] = result['passed'] and bool(drift < 1e-6)
+
+    print(f"Recovery: median error {result['median_error']:.3f}, max error {result['max_error']:.3f}"
+          + (f", drift from reference {result['reference_drift']:.2e}" if reference is not None else "")
+          + f" -> {'PASS' if result['passed'] else 'FAIL'}")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(old, new):
+    """
+    Prints the speedup of every benchmark in new relative to old.
+    """
+    old_times = {(r['name'], r['teams'], r['seasons']): r['best'] for r in old['results']}
+    print(f"Comparing {old.get('commit')} -> {new.get('commit')}")
+    for r in new['results']:
+        key = (r['name'], r['teams'], r['seasons'])
+        if key in old_times:
+            print(f"{r['name']:<22}{r['teams']:>4} teams {r['seasons']:>2} seasons  {old_times[key] / r['best']:8.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for fitting, FDR and simulation on synthetic leagues.")
+    parser.add_argument('--output', default='bench.json', help="Where to store the results.")
+    parser.add_argument('--compare', help="Results of an earlier run to compare against.")
+    parser.add_argument('--check', action='store_true', help="Check parameter recovery instead of timing.")
+    parser.add_argument('--reference', help="Recovery result of an earlier run the fit must reproduce.")
+    parser.add_argument('--joint', action='store_true', help="Time and check the sparse joint fit at 50k x 2k.")
+    parser.add_argument('--max-steps', type=int, default=None, help="Gradient steps in maximize.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'timestamp': datetime.now().isoformat()}
+    if args.joint:
+        report['joint'] = check_joint(seed=args.seed)
+    elif args.check:
+        reference = None
+        if args.reference:
+            with open(args.reference) as f:
+                reference = json.load(f)['recovery']
+        report['recovery'] = check_recovery(max_steps=args.max_steps or 300, seed=args.seed, reference=reference)
+    else:
+        report['results'] = run_benchmarks(max_steps=args.max_steps or 5, seed=args.seed)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), report)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,171 @@
+import re
+import numpy as np
+import pandas as pd
+import requests
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Opening tag of any table with an id, wherever it is in the page, including the tables FBref ships inside HTML
+# comments and only renders with javascript.
+_TABLE_OPEN = re.compile(r'<table\b[^>]*\bid="([^"]+)"[^>]*>', re.IGNORECASE)
+_TABLE_CLOSE = re.compile(r'</table\s*>', re.IGNORECASE)
+
+
+def fetch_page(url):
+    """
+    :return: Page HTML as text.
+    """
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.text
+
+
+def find_tables(html, key=None):
+    """
+    Locates tables in the raw HTML without parsing the page.
+
+    :param html: Page HTML.
+    :param key: Only tables whose id ends with key, all tables if None.
+    :return: Dict of table id to the HTML of just that table.
+    """
+    tables = {}
+    for match in _TABLE_OPEN.finditer(html):
+        table_id = match.group(1)
+        if key is not None and not table_id.endswith(key):
+            continue
+        close = _TABLE_CLOSE.search(html, match.end())
+        if close is None:
+            continue
+        tables[table_id] = html[match.start():close.end()]
+    return tables
+
+
+def _rows_lxml(table_html):
+    table = lxml.html.fragment_fromstring(table_html)
+    header_rows = table.xpath('./thead/tr')
+    header = [cell.text_content().strip() for cell in header_rows[-1]] if header_rows else None
+    rows = []
+    for tr in table.xpath('./tbody/tr'):
+        if 'thead' in (tr.get('class') or '') or 'spacer' in (tr.get('class') or ''):
+            continue
+        rows.append([cell.text_content().strip() for cell in tr])
+    return header, rows
+
+
+def _rows_soup(table_html):
+    # Fallback when lxml is not installed: only the table goes through the pure python parser.
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    table = BeautifulSoup(table_html, 'html.parser', parse_only=SoupStrainer('table')).table
+    header_rows = table.thead.find_all('tr') if table.thead else []
+    header = [cell.get_text(strip=True) for cell in header_rows[-1].find_all(['th', 'td'])] if header_rows else None
+    rows = []
+    for tr in table.tbody.find_all('tr') if table.tbody else []:
+        classes = tr.get('class') or []
+        if 'thead' in classes or 'spacer' in classes:
+            continue
+        rows.append([cell.get_text(strip=True) for cell in tr.find_all(['th', 'td'])])
+    return header, rows
+
+
+def _column_names(header, width):
+    if header is None or len(header) != width:
+        return [f"col{i}" for i in range(width)]
+    # FBref repeats names under different over-headers (e.g. xG for and against), later ones get a suffix.
+    seen = {}
+    names = []
+    for name in header:
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else f"{name}.{seen[name] - 1}")
+    return names
+
+
+def _typed(values):
+    """
+    :return: The column as a float array if every non empty value is numeric, else as an object array.
+    """
+    cleaned = [value.replace(',', '') for value in values]
+    try:
+        return np.array([float(value) if value else np.nan for value in cleaned])
+    except ValueError:
+        return np.array(values, dtype=object)
+
+
+def parse_table(table_html, backend='auto'):
+    """
+    Parses the HTML of a single table into typed columns.
+
+    :param backend: 'lxml', 'soup' (BeautifulSoup) or 'auto', which picks lxml when it is installed.
+    :return: DataFrame with one column per table column, numeric columns as floats.
+    """
+    if backend == 'auto':
+        backend = 'lxml' if lxml is not None else 'soup'
+    header, rows = _rows_lxml(table_html) if backend == 'lxml' else _rows_soup(table_html)
+    width = max((len(row) for row in rows), default=len(header or []))
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    names = _column_names(header, width)
+    columns = list(zip(*rows)) if rows else [[] for _ in names]
+    return pd.DataFrame({name: _typed(list(column)) for name, column in zip(names, columns)})
+
+
+def extract_tables(html, key=None):
+    """
+    :param html: Page HTML.
+    :param key: Only tables whose id ends with key, all tables if None.
+    :return: Dict of table id to DataFrame.
+    """
+    return {table_id: parse_table(table_html) for table_id, table_html in find_tables(html, key).items()}
+
+
+def get_stats_table(key, page):
+    """
+    Reads the first table whose id ends with key.
+
+    :param key: End of the table id, e.g. "overall" for the league table.
+    :param page: Page HTML, or an already parsed BeautifulSoup element.
+    :return: DataFrame
+    """
+    html = page if isinstance(page, str) else str(page)
+    tables = find_tables(html, key)
+    if not tables:
+        raise ValueError(f"No table with an id ending in {key!r}")
+    return parse_table(next(iter(tables.values())))
+
+
+def check_offline(path='samples/fbref_stats.html'):
+    """
+    Checks the extraction against a saved FBref page, without the network: the league table and the squad table
+    FBref ships inside an HTML comment must both be found, and the lxml path and the BeautifulSoup fallback must
+    return the same frames.
+
+    :return: True if every check passes.
+    """
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+
+    passed = True
+    for key, rows in (('overall', 4), ('standard_for', 3)):
+        tables = find_tables(html, key)
+        ok = len(tables) == 1
+        if ok:
+            table_html = next(iter(tables.values()))
+            frames = {'soup': parse_table(table_html, backend='soup')}
+            if lxml is not None:
+                frames['lxml'] = parse_table(table_html, backend='lxml')
+            ok = all(len(frame) == rows for frame in frames.values())
+            if ok and 'lxml' in frames:
+                try:
+                    pd.testing.assert_frame_equal(frames['lxml'], frames['soup'])
+                except AssertionError:
+                    ok = False
+        print(f"{key:<14} {'ok' if ok else 'MISMATCH'}")
+        passed = passed and ok
+    return passed
+
+
+if __name__ == '__main__':
+    # Offline check of the extraction against the saved page.
+    raise SystemExit(0 if check_offline() else 1)
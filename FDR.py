@@ -4,9 +4,17 @@ import requests
 from fpl import FPL
 import aiohttp
 import asyncio
+import argparse
 import json
+import os
+import threading
+import time
 import numpy as np
+from bisect import bisect_right
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from ModelArtifact import ModelArtifact
 
 black = (40, 40, 40)
 white = (255, 255, 255)
@@ -17,11 +25,90 @@ blue = (0, 220, 255)
 yellow = (255, 255, 125)
 star = (255, 255, 0)
 
+# Posted to the pygame loop by DataRefresher when new fixtures, gameweeks or ratings are ready.
+DATA_REFRESHED = pg.USEREVENT + 1
+CACHE_PATH = 'fdr_cache.json'
+
+
+# Shared font and rendered text surfaces. SysFont scans the system fonts on every call, and every cell in the grid
+# renders one of a handful of short strings, so both are created once and reused by all GW, Fixture and Team cells.
+_FONTS = {}
+_TEXT_SURFACES = {}
+
+
+def get_font(name='Arial', size=16):
+    key = (name, size)
+    if key not in _FONTS:
+        _FONTS[key] = pg.font.SysFont(name, size)
+    return _FONTS[key]
+
+
+def render_text(text, color=black):
+    """
+    Renders text with the shared font, reusing the surface if the same (text, colour) has been rendered before.
+    """
+    key = (text, color)
+    if key not in _TEXT_SURFACES:
+        _TEXT_SURFACES[key] = get_font().render(text, True, color, None)
+    return _TEXT_SURFACES[key]
+
+
+@lru_cache(maxsize=None)
+def parse_date(date):
+    return datetime.strptime(date, "%Y-%m-%d")
+
+
+class StartupProfile:
+    """
+    Records wall time per startup phase, enabled by running FDR.py with --profile.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = sum(elapsed for _, elapsed in self.phases)
+        print("Startup profile:")
+        for name, elapsed in self.phases:
+            print(f"  {name:<24}{elapsed * 1000:10.1f} ms")
+        print(f"  {'total':<24}{total * 1000:10.1f} ms")
+
 
 def predicted_goals(a, b, hfa=1):
     return a*b*hfa
 
 
+def fixture_colors(gs, ga, steepness=4):
+    """
+    Vectorized version of Fixture.set_color, computes the cell colours of many fixtures at once.
+
+    :param gs: Array of goals scored
+    :param ga: Array of goals against
+    :param steepness: How fast the colour saturates with the goal difference
+    :return: List of (r, g, b) tuples
+    """
+    diff = np.asarray(gs, dtype=float) - np.asarray(ga, dtype=float)
+    grad = (100 / (1 + np.exp(-1 * np.abs(diff)))) - 50
+    negative = diff < 0
+    r = np.where(negative, 255, 255 - steepness*grad)
+    g = 255 - steepness*grad
+    b = np.where(negative, 255 - steepness*grad, 255 - grad)
+    return list(zip(r.tolist(), g.tolist(), b.tolist()))
+
+
 def translate_team_names(team):
     if team == 'Leicester':
         team = 'Leicester City'
@@ -40,6 +127,45 @@ def translate_team_names(team):
     return team
 
 
+def expected_goals_matrix(fixtures, team_data, gws):
+    """
+    Headless version of the FDR grid: expected goals of every team in every gameweek.
+
+    :param fixtures: Dict of fixtures keyed by team name, as returned by get_fixtures.
+    :param team_data: DataFrame with columns Team, Attacking Strength, Defensive Strength and HFA.
+    :param gws: List of gameweek deadline dates ("%Y-%m-%d").
+    :return: (teams, GS, GA, N) where GS and GA are (teams x GWs) arrays of expected goals scored and conceded,
+             summed over double gameweeks, and N is the number of fixtures of each team in each GW.
+    """
+    teams = [translate_team_names(team) for team in fixtures]
+    index = {team: i for i, team in enumerate(teams)}
+    ratings = team_data.set_index('Team')
+    a = ratings.loc[teams, 'Attacking Strength'].values.astype(float)
+    b = ratings.loc[teams, 'Defensive Strength'].values.astype(float)
+    hfa = team_data['HFA'].values[0]
+
+    deadlines = [parse_date(gw) for gw in gws]
+    rows, cols, opps, home = [], [], [], []
+    for team, team_fixtures in fixtures.items():
+        for fixture in team_fixtures:
+            rows.append(index[translate_team_names(team)])
+            opps.append(index[translate_team_names(fixture['opponent'])])
+            cols.append(max(bisect_right(deadlines, parse_date(fixture['date'])) - 1, 0))
+            home.append(fixture['home'])
+    rows, cols, opps = np.array(rows, dtype=int), np.array(cols, dtype=int), np.array(opps, dtype=int)
+    home = np.array(home, dtype=bool)
+
+    gs = predicted_goals(a[rows], b[opps], np.where(home, hfa, 1))
+    ga = predicted_goals(a[opps], b[rows], np.where(home, 1, hfa))
+
+    shape = (len(teams), len(gws))
+    GS, GA, N = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=int)
+    np.add.at(GS, (rows, cols), gs)
+    np.add.at(GA, (rows, cols), ga)
+    np.add.at(N, (rows, cols), 1)
+    return teams, GS, GA, N
+
+
 class GW:
     def __init__(self, date, n, order, width, height):
         self.start_date = date
@@ -47,8 +173,7 @@ class GW:
         self.order = order
 
         self.text = str(self.number)
-        self.font = pg.font.SysFont('Arial', 16)
-        self.display_text = self.font.render(self.text, True, black, None)
+        self.display_text = render_text(self.text)
         self.text_rect = self.display_text.get_rect()
         self.x, self.y = (order + 1) * width + (order + 1) * 2, 2
         self.center = (self.x + width / 2, height / 2)
@@ -83,8 +208,7 @@ class Fixture:
         self.league_average = average
 
         self.text = opponent
-        self.font = pg.font.SysFont('Arial', 16)
-        self.display_text = self.font.render(self.text, True, black, None)
+        self.display_text = render_text(self.text)
         self.text_rect = self.display_text.get_rect()
         self.x, self.y = xy[0] - width / 2, xy[1] - height / 2
         self.center = xy
@@ -95,6 +219,16 @@ class Fixture:
         # We want the color scheme to be 255 as
         self.color = self.set_color()
 
+    def aspect_goals(self, key):
+        """
+        :return: (GS, GA) shown in the cell for the given aspect key.
+        """
+        if key == 2:
+            return self.goals_for, self.league_average
+        elif key == 3:
+            return self.league_average, self.goals_against
+        return self.goals_for, self.goals_against
+
     def set_color(self, steepness=4):
         """
         We want the color to be (255, 255, 255) when the goal difference is 0, so
@@ -118,18 +252,13 @@ class Fixture:
         self.text_rect.center = self.center
         self.rect = pg.Rect(self.x, self.y, self.width, self.height)
 
-    def change_aspect(self, key):
-        if key == 1:
-            self.GS = self.goals_for
-            self.GA = self.goals_against
-        elif key == 2:
-            self.GS = self.goals_for
-            self.GA = self.league_average
-        elif key == 3:
-            self.GS = self.league_average
-            self.GA = self.goals_against
-
-        self.color = self.set_color(steepness=4 if key == 1 else 6)
+    def change_aspect(self, key, color=None):
+        """
+        :param key: Aspect to show, 1 = both, 2 = attack, 3 = defence.
+        :param color: Precomputed colour for the cell (see FDR.change_aspect), computed here if not given.
+        """
+        self.GS, self.GA = self.aspect_goals(key)
+        self.color = color if color is not None else self.set_color(steepness=4 if key == 1 else 6)
 
 
 class Team:
@@ -142,8 +271,7 @@ class Team:
 
         # Setting team rect:
         self.text = self.name
-        self.font = pg.font.SysFont('Arial', 16)
-        self.display_text = self.font.render(self.text, True, black, None)
+        self.display_text = render_text(self.text)
         self.text_rect = self.display_text.get_rect()
         self.center = center
         self.text_rect.center = self.center
@@ -157,18 +285,19 @@ class Team:
 
 
 class FDR:
-    def __init__(self, fixtures, team_data, gws, curr_gw, average):
-        pg.init()
+    def __init__(self, fixtures, team_data, gws, curr_gw, average, profile=None):
+        self.profile = profile if profile is not None else StartupProfile(enabled=False)
 
-        self.fixtures = fixtures
-        self.team_data = team_data
+        with self.profile.phase('pygame init'):
+            pg.init()
 
         self.window_width = 1096
         self.window_height = 800
 
         # We initiate the game display onto which we will draw our objects.
-        self.display = pg.display.set_mode((self.window_width, self.window_height))
-        pg.display.set_caption("Fixture Difficulty Ratings")
+        with self.profile.phase('display'):
+            self.display = pg.display.set_mode((self.window_width, self.window_height))
+            pg.display.set_caption("Fixture Difficulty Ratings")
 
         # Setting initial game necessities
         self.exit = False
@@ -191,17 +320,50 @@ class FDR:
         }
 
         # Setting up the FDR table:
+        self.space_sz = 3
+        self.cell_width = 120
+        self.aspect = 1
+        self.build_table(fixtures, team_data, gws, curr_gw, average)
+
+    def build_table(self, fixtures, team_data, gws, curr_gw, average):
+        """
+        (Re)builds the whole grid, at startup and whenever DataRefresher posts new data. The table stays empty until
+        there are fixtures, ratings and gameweeks to show.
+        """
+        self.fixtures = fixtures
+        self.team_data = team_data
         self.teams = []
+        self.gws = []
+        self.gw_deadlines = []
+
+        # Colours of every fixture cell per aspect key, filled in lazily by change_aspect.
+        self.aspect_colors = {}
+
+        if not fixtures or team_data is None or not gws:
+            return
+
         self.no_rows = len(fixtures)
-        self.space_sz = 3
         self.cell_height = int((self.window_height - (self.no_rows + 1)*self.space_sz) / (self.no_rows + 1))
-        self.cell_width = 120
 
+        with self.profile.phase('gameweeks'):
+            self.build_gws(gws, curr_gw)
+        with self.profile.phase('teams'):
+            self.build_teams(fixtures, team_data)
+        with self.profile.phase('fixtures'):
+            self.build_fixtures(fixtures, team_data, curr_gw, average)
+
+        if self.aspect != 1:
+            self.change_aspect(self.aspect)
+
+    def build_gws(self, gws, curr_gw):
         # Creating instances of our GWs.
         self.gws = []
         for k in range(len(gws)):
             self.gws.append(GW(gws[k], curr_gw + k, k, self.cell_width, self.cell_height))
+        # Deadlines are parsed once here rather than for every fixture in find_gw.
+        self.gw_deadlines = [parse_date(gw.start_date) for gw in self.gws]
 
+    def build_teams(self, fixtures, team_data):
         # Creating instances of our teams.
         i = 0
         for team in fixtures:
@@ -220,6 +382,7 @@ class FDR:
             self.teams.append(Team(team, (self.cell_width / 2, y), self.cell_width, self.cell_height, a, b, short))
             i += 1
 
+    def build_fixtures(self, fixtures, team_data, curr_gw, average):
         # Normalizing team names
         team_names = list(self.fixtures.keys())
 
@@ -252,14 +415,23 @@ class FDR:
                                          team.center, self.cell_width, self.cell_height, len(team.fixtures), gw, average))
 
     def find_gw(self, date):
-        fixture_date = datetime.strptime(date, "%Y-%m-%d")
-        for gw in self.gws:
-            gw_deadline = datetime.strptime(gw.start_date, "%Y-%m-%d")
-            if (fixture_date - gw_deadline).days >= 0:
-                max = gw
-            else:
-                return max
-        return self.gws[len(self.gws) - 1]
+        """
+        :return: The last GW whose deadline is on or before the fixture date.
+        """
+        k = bisect_right(self.gw_deadlines, parse_date(date)) - 1
+        return self.gws[max(k, 0)]
+
+    def change_aspect(self, key):
+        """
+        Switches every fixture cell to the given aspect, computing the colours of all cells in one batch.
+        """
+        self.aspect = key
+        fixtures = [fixture for team in self.teams for fixture in team.fixtures]
+        if key not in self.aspect_colors:
+            goals = np.array([fixture.aspect_goals(key) for fixture in fixtures], dtype=float).reshape(-1, 2)
+            self.aspect_colors[key] = fixture_colors(goals[:, 0], goals[:, 1], steepness=4 if key == 1 else 6)
+        for fixture, color in zip(fixtures, self.aspect_colors[key]):
+            fixture.change_aspect(key, color)
 
     def get_team(self, name):
         for team in self.teams:
@@ -275,18 +447,17 @@ class FDR:
                 self.exit = True
 
             elif event.key == pg.K_1:
-                for team in self.teams:
-                    for fixture in team.fixtures:
-                        fixture.change_aspect(1)
+                self.change_aspect(1)
             elif event.key == pg.K_2:
-                for team in self.teams:
-                    for fixture in team.fixtures:
-                        fixture.change_aspect(2)
+                self.change_aspect(2)
             elif event.key == pg.K_3:
-                for team in self.teams:
-                    for fixture in team.fixtures:
-                        fixture.change_aspect(3)
+                self.change_aspect(3)
+
 
+    # Swaps in new data posted by the background refresh.
+    def check_refresh(self, event):
+        if event.type == DATA_REFRESHED:
+            self.build_table(**event.data)
 
     # Checks for mouse click events, and sets relevant instance variable if there was any.
     def check_mouse_click(self, event):
@@ -314,6 +485,7 @@ class FDR:
         for event in pg.event.get():
             self.check_exit(event)
             self.check_mouse_click(event)
+            self.check_refresh(event)
         self.check_arrow_click()
 
     def display_teams(self):
@@ -333,6 +505,8 @@ class FDR:
         """
         Shifts the table to the left and to the right, depending on whether the keys 'a' or 'd' are pressed.
         """
+        if not self.gws:
+            return False
         if self.shift_left and not self.shift_right:
             if self.gws[0].x > self.cell_width + 2:
                 return False
@@ -456,21 +630,116 @@ def calculate_league_average(team_ratings):
     return average
 
 
-if __name__ == '__main__':
-
-    team_ratings = pd.read_csv('Team Ratings.csv')
-    team_ratings = pd.DataFrame(team_ratings)
+def load_ratings(model=None):
+    """
+    :param model: Model artifact to read the ratings from, Team Ratings.csv if None.
+    :return: Ratings with short names.
+    """
+    if model:
+        team_ratings = ModelArtifact.load(model).ratings_table()
+    else:
+        team_ratings = pd.read_csv('Team Ratings.csv')
+        team_ratings = pd.DataFrame(team_ratings)
 
     short_names = pd.read_csv('short_names.csv')
 
-    team_ratings['Short'] = short_names['Short'].values
+    if model:
+        # The artifact has its own team order, so short names are matched by team. Teams missing from
+        # short_names.csv get the first three letters, like TeamVis.build_league.
+        team_ratings['Short'] = team_ratings['Team'].map(dict(zip(short_names['Team'], short_names['Short']))) \
+            .fillna(team_ratings['Team'].str[:3].str.upper())
+    else:
+        team_ratings['Short'] = short_names['Short'].values
+    return team_ratings
+
+
+def load_cache(path=CACHE_PATH):
+    """
+    :return: Fixtures and gameweeks of the last successful refresh, or None.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(fixtures, gws, curr_gw, path=CACHE_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'fixtures': fixtures, 'gws': gws, 'curr_gw': curr_gw,
+                   'updated': datetime.now().isoformat(timespec='seconds')}, f)
+    os.replace(tmp_path, path)
+
+
+class DataRefresher:
+    """
+    Refreshes fixtures, gameweek deadlines and ratings on a background thread running its own asyncio loop, and
+    posts the result to the pygame loop as a DATA_REFRESHED event, so the window never waits on the network.
+    """
+    def __init__(self, model=None, interval=600, cache_path=CACHE_PATH):
+        """
+        :param model: Model artifact to read the ratings from, Team Ratings.csv if None.
+        :param interval: Seconds between refreshes.
+        :param cache_path: Where the last fetched fixtures and gameweeks are kept for the next startup.
+        """
+        self.model = model
+        self.interval = interval
+        self.cache_path = cache_path
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.refresh_loop()), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    async def refresh_loop(self):
+        while True:
+            try:
+                data = await self.fetch()
+                pg.event.post(pg.event.Event(DATA_REFRESHED, {'data': data}))
+            except Exception as error:
+                # The window keeps showing the data it has, the next refresh tries again.
+                print(f"FDR refresh failed: {error}")
+            await asyncio.sleep(self.interval)
+
+    async def fetch(self):
+        """
+        Fetches and parses everything off the pygame thread.
+
+        :return: Keyword arguments for FDR.build_table.
+        """
+        (fixtures, (gws, curr_gw), team_ratings) = await asyncio.gather(
+            asyncio.to_thread(get_fixtures), main(), asyncio.to_thread(load_ratings, self.model))
+        # Saved before FDR renames the teams in fixtures.
+        await asyncio.to_thread(save_cache, fixtures, gws, curr_gw, self.cache_path)
+        average = calculate_league_average(team_ratings)
+        return {'fixtures': fixtures, 'team_data': team_ratings, 'gws': gws, 'curr_gw': curr_gw, 'average': average}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fixture Difficulty Ratings.")
+    parser.add_argument('--profile', action='store_true', help="Print the time spent in every startup phase.")
+    parser.add_argument('--model', help="Model artifact to use, instead of Team Ratings.csv.")
+    parser.add_argument('--refresh', type=float, default=600, help="Seconds between background data refreshes.")
+    args = parser.parse_args()
+
+    profile = StartupProfile(enabled=args.profile)
+
+    # The window opens straight away with the cached fixtures (or empty), fresh data is swapped in once fetched.
+    with profile.phase('read ratings'):
+        team_ratings = load_ratings(args.model)
 
-    fixtures = get_fixtures()
+    with profile.phase('read cache'):
+        cached = load_cache()
+        fixtures = cached['fixtures'] if cached else {}
+        GWs, curr_gw = (cached['gws'], cached['curr_gw']) if cached else ([], 1)
 
-    gw_info = asyncio.run(main())
-    GWs, curr_gw = gw_info[0], gw_info[1]
+    with profile.phase('league average'):
+        average = calculate_league_average(team_ratings)
 
-    average = calculate_league_average(team_ratings)
+    fdr = FDR(fixtures=fixtures, team_data=team_ratings, gws=GWs, curr_gw=curr_gw, average=average, profile=profile)
+    profile.report()
 
-    fdr = FDR(fixtures=fixtures, team_data=team_ratings, gws=GWs, curr_gw=curr_gw, average=average)
+    DataRefresher(model=args.model, interval=args.refresh).start()
     fdr.run()
@@ -1,7 +1,5 @@
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup as soup
-from DataScraper import get_stats_table
+from DataScraper import get_stats_table, fetch_page
 import numpy as np
 
 
@@ -45,6 +43,8 @@ class Team:
         self.b = b
         self.attack_rate = None
         self.defence_rate = None
+        self.attack_error = None
+        self.defence_error = None
         self.results = []
         if results is not None:
             self.add_results(results)
@@ -58,6 +58,10 @@ class Team:
     def set_defence_rate(self, defence_rate):
         self.defence_rate = defence_rate
 
+    def set_rate_errors(self, attack_error, defence_error):
+        self.attack_error = attack_error
+        self.defence_error = defence_error
+
     def add_results(self, results):
         for index, result in results.iterrows():
             self.add_result(result)
@@ -91,11 +95,8 @@ if __name__ == '__main__':
     # We also want team to have fixtures and past results.
     curr_season = "https://fbref.com/en/comps/9/Premier-League-Stats"
 
-    p = requests.get(curr_season)
-    p = soup(p.text, 'html.parser')
-    p = p.find(id='content')
-
-    league_table = get_stats_table("overall", p)
+    # Only the league table is parsed, not the whole page.
+    league_table = get_stats_table("overall", fetch_page(curr_season))
     curr_teams = league_table[['Squad']].copy()
     ts = pd.Series(curr_teams['Squad'].values, index=curr_teams['Squad'])
     ts = ts.str.strip()
@@ -0,0 +1,140 @@
+import argparse
+import time
+import numpy as np
+from scipy import stats
+
+from Prediction import expected_goals
+
+# Multipliers of a team's remaining scoring rate per red card it has received (own) and per red card its opponent
+# has received (opponent).
+RED_CARD_OWN = 0.75
+RED_CARD_OPPONENT = 1.3
+
+
+class InPlayEngine:
+    """
+    Result probabilities of live matches, for all of them in one vectorized call.
+
+    The goals still to come in a match are Poisson with the pre-match rates scaled by the share of the match left
+    and by the red cards. The final scoreline is the current score plus the remaining goals. Poisson pmfs are read
+    from a table over a grid of rates, built once, and interpolated linearly, so an update is a few array lookups
+    and one (matches x goals x goals) product.
+
+    The tau correction of the pre-match model is left out, it describes low full-match scores and has no obvious
+    meaning for the rest of a match.
+    """
+    def __init__(self, max_goals=10, match_length=90, max_rate=8.0, resolution=2000):
+        """
+        :param max_goals: Largest final number of goals per team, the rest of the tail is dropped.
+        :param match_length: Minutes in a match, a minute past it (stoppage time) leaves nothing to play.
+        :param max_rate: Largest remaining rate in the table, larger rates are clipped.
+        :param resolution: Table rows per unit of rate.
+        """
+        self.max_goals = max_goals
+        self.match_length = match_length
+        self.resolution = resolution
+
+        self.goals = np.arange(max_goals + 1)
+        self.rates = np.arange(int(max_rate * resolution) + 2) / resolution
+        self.pmf_table = stats.poisson.pmf(self.goals[np.newaxis, :], self.rates[:, np.newaxis])
+
+        self.home_mask = np.tril(np.ones((max_goals + 1, max_goals + 1)), -1)
+        self.draw_mask = np.eye(max_goals + 1)
+        self.away_mask = np.triu(np.ones((max_goals + 1, max_goals + 1)), 1)
+
+    def remaining_rates(self, lamb, mu, minute, home_reds=0, away_reds=0):
+        """
+        :return: (home, away) expected goals in the rest of every match.
+        """
+        left = np.clip(1 - np.asarray(minute, dtype=float) / self.match_length, 0, 1)
+        home_reds = np.asarray(home_reds, dtype=float)
+        away_reds = np.asarray(away_reds, dtype=float)
+        home = lamb * left * RED_CARD_OWN**home_reds * RED_CARD_OPPONENT**away_reds
+        away = mu * left * RED_CARD_OWN**away_reds * RED_CARD_OPPONENT**home_reds
+        return home, away
+
+    def pmf(self, rates):
+        """
+        :return: Array of shape (n, max_goals + 1), the Poisson pmfs of rates, interpolated from the table.
+        """
+        position = np.clip(rates * self.resolution, 0, len(self.rates) - 2)
+        row = position.astype(np.int64)
+        weight = (position - row)[:, np.newaxis]
+        return (1 - weight) * self.pmf_table[row] + weight * self.pmf_table[row + 1]
+
+    def final_pmf(self, rates, goals):
+        """
+        :return: Array of shape (n, max_goals + 1), the distribution of the final number of goals: the pmf of the
+                 remaining goals shifted by the goals already scored.
+        """
+        shift = self.goals[np.newaxis, :] - np.asarray(goals, dtype=np.int64)[:, np.newaxis]
+        remaining = self.pmf(rates)
+        return np.where(shift >= 0, np.take_along_axis(remaining, np.clip(shift, 0, None), axis=1), 0)
+
+    def update(self, lamb, mu, home_goals, away_goals, minute, home_reds=0, away_reds=0):
+        """
+        Final scoreline and result probabilities of all live matches.
+
+        :param lamb: Array of pre-match expected home goals, e.g. from Prediction.expected_goals.
+        :param mu: Array of pre-match expected away goals.
+        :param home_goals: Array of current home goals.
+        :param away_goals: Array of current away goals.
+        :param minute: Array of minutes played.
+        :param home_reds: Array of red cards of the home teams.
+        :param away_reds: Array of red cards of the away teams.
+        :return: Dict with scores (array of shape (n, max_goals + 1, max_goals + 1), entry [k, x, y] is
+                 P(final score x - y) in match k), home_xg and away_xg (expected final goals), p_home, p_draw and
+                 p_away.
+        """
+        home_rate, away_rate = self.remaining_rates(np.asarray(lamb, dtype=float), np.asarray(mu, dtype=float),
+                                                    minute, home_reds, away_reds)
+        home_pmf = self.final_pmf(home_rate, home_goals)
+        away_pmf = self.final_pmf(away_rate, away_goals)
+        scores = home_pmf[:, :, np.newaxis] * away_pmf[:, np.newaxis, :]
+        return {
+            'scores': scores,
+            'home_xg': np.asarray(home_goals) + home_rate,
+            'away_xg': np.asarray(away_goals) + away_rate,
+            'p_home': np.einsum('kxy,xy->k', scores, self.home_mask),
+            'p_draw': np.einsum('kxy,xy->k', scores, self.draw_mask),
+            'p_away': np.einsum('kxy,xy->k', scores, self.away_mask)
+        }
+
+
+class LiveMatches:
+    """
+    The live matches of a matchday: pre-match rates are looked up in the model once at kickoff, every update after
+    that only passes the match states to the engine.
+    """
+    def __init__(self, model, home, away, engine=None):
+        """
+        :param model: ModelArtifact
+        :param home: Home team names.
+        :param away: Away team names.
+        """
+        self.home = list(home)
+        self.away = list(away)
+        self.lamb, self.mu = expected_goals(model, self.home, self.away)
+        self.engine = engine if engine is not None else InPlayEngine()
+
+    def update(self, home_goals, away_goals, minute, home_reds=0, away_reds=0):
+        return self.engine.update(self.lamb, self.mu, home_goals, away_goals, minute, home_reds, away_reds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency of in-play updates.")
+    parser.add_argument('--matches', type=int, default=10, help="Live matches per update.")
+    parser.add_argument('--updates', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    engine = InPlayEngine()
+    lamb, mu = rng.uniform(0.8, 2.2, args.matches), rng.uniform(0.6, 1.8, args.matches)
+    states = [(rng.integers(0, 3, args.matches), rng.integers(0, 3, args.matches), rng.uniform(0, 95, args.matches),
+               rng.integers(0, 2, args.matches), rng.integers(0, 2, args.matches)) for _ in range(args.updates)]
+
+    start = time.perf_counter()
+    for state in states:
+        engine.update(lamb, mu, *state)
+    elapsed = time.perf_counter() - start
+    print(f"{args.matches} matches: {elapsed / args.updates * 1e6:.0f} us per update")
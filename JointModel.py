@@ -0,0 +1,125 @@
+import time
+import numpy as np
+import pandas as pd
+from scipy import optimize, sparse
+
+from TeamStrength import encode_matches
+from ModelArtifact import ModelArtifact
+
+
+def incidence(index, n):
+    """
+    :return: Sparse (matches x n) matrix with a single one per row, in column index[k].
+    """
+    m = len(index)
+    return sparse.csr_matrix((np.ones(m), (np.arange(m), index)), shape=(m, n))
+
+
+class JointFit:
+    """
+    Result of fit_joint: one strength scale for every team, and a home field advantage per competition.
+    """
+    def __init__(self, teams, a, b, competitions, hfa, rho, log_likelihood, iterations, seconds):
+        self.teams = teams
+        self.a = a
+        self.b = b
+        self.competitions = competitions
+        self.hfa = hfa
+        self.rho = rho
+        self.log_likelihood = log_likelihood
+        self.iterations = iterations
+        self.seconds = seconds
+
+    def to_artifact(self, competition, teams=None, data_hash=None):
+        """
+        :param competition: Competition whose home field advantage the artifact uses.
+        :param teams: Teams to keep, defaults to all of them.
+        :return: ModelArtifact
+        """
+        keep = np.arange(len(self.teams)) if teams is None else np.array([self.teams.index(t) for t in teams])
+        return ModelArtifact([self.teams[i] for i in keep], self.hfa[competition], self.rho, self.a[keep],
+                             self.b[keep], data_hash, {'joint': True, 'competition': competition},
+                             {'iterations': self.iterations, 'fit_seconds': self.seconds})
+
+    def ratings_table(self):
+        return pd.DataFrame({'Team': self.teams, 'Attacking Strength': self.a, 'Defensive Strength': self.b})
+
+
+def fit_joint(match_data, competition='Comp', ridge=1e-2, rho=0.1, t=0.0065, today=None, max_iter=100, gtol=1e-6):
+    """
+    Fits every team of many divisions and competitions on one scale.
+
+    The model is the same as in maximize, but parameterised by log a, log b and log HFA per competition so all
+    parameters are unconstrained, and built on sparse team incidence matrices rather than nested dicts: every
+    match is one row with a one in its home and away team's columns. Likelihood, gradient and Hessian-vector
+    products are sparse matrix products, so time and memory are linear in matches + teams, and the fit is a trust
+    region Newton-CG. Like the gradient in maximize, tau is left out and rho is only carried along.
+
+    Adding a constant to every log a and subtracting it from every log b does not change the likelihood, separately
+    for every group of teams that never meet, so a small ridge penalty on log a and log b pins the scale down.
+
+    :param match_data: DataFrame with columns Date, H, A, xG, xGA, and optionally the competition column.
+    :param competition: Column naming the competition of every match, each gets its own HFA.
+    :param ridge: Strength of the penalty on log a and log b, in units of the (weighted) log likelihood.
+    :param rho: Low score dependence, carried over to the result.
+    :param t: Decay rate.
+    :param today: Date the decay weights are relative to, defaults to now.
+    :return: JointFit
+    """
+    start = time.perf_counter()
+    data = encode_matches(match_data, t=t, today=today)
+    n = len(data['teams'])
+
+    if competition in match_data:
+        competitions = sorted(match_data[competition].unique())
+        comp_index = match_data[competition].map({c: i for i, c in enumerate(competitions)}).values
+    else:
+        competitions = ['All']
+        comp_index = np.zeros(len(match_data), dtype=np.int64)
+    n_comps = len(competitions)
+
+    home = incidence(data['home'], n)
+    away = incidence(data['away'], n)
+    comps = incidence(comp_index, n_comps)
+    # log(lamb) = log a_home + log b_away + log gamma_comp, log(mu) = log a_away + log b_home
+    jx = sparse.hstack([home, away, comps], format='csr')
+    jy = sparse.hstack([away, home, sparse.csr_matrix((len(match_data), n_comps))], format='csr')
+    jx_t, jy_t = jx.T.tocsr(), jy.T.tocsr()
+
+    # Normalising by the total weight keeps the objective and gtol on the same scale for any amount of data.
+    total = data['w'].sum()
+    wx, wy = data['w'] * data['x'] / total, data['w'] * data['y'] / total
+    w = data['w'] / total
+    penalty = np.concatenate([np.full(2 * n, ridge / total), np.zeros(n_comps)])
+
+    state = {}
+
+    def rates(theta):
+        # The objective, gradient and Hessian are evaluated at the same theta, so the rates are computed once.
+        if state.get('theta') is None or not np.array_equal(state['theta'], theta):
+            eta_x, eta_y = jx @ theta, jy @ theta
+            state.update(theta=theta.copy(), eta_x=eta_x, eta_y=eta_y, lamb=np.exp(eta_x), mu=np.exp(eta_y))
+        return state
+
+    def objective(theta):
+        s = rates(theta)
+        ll = wx @ s['eta_x'] - w @ s['lamb'] + wy @ s['eta_y'] - w @ s['mu']
+        return -ll + 0.5 * penalty @ theta**2
+
+    def gradient(theta):
+        s = rates(theta)
+        return -(jx_t @ (wx - w * s['lamb']) + jy_t @ (wy - w * s['mu'])) + penalty * theta
+
+    def hessp(theta, v):
+        s = rates(theta)
+        return jx_t @ (w * s['lamb'] * (jx @ v)) + jy_t @ (w * s['mu'] * (jy @ v)) + penalty * v
+
+    theta0 = np.zeros(2 * n + n_comps)
+    result = optimize.minimize(objective, theta0, jac=gradient, hessp=hessp, method='trust-ncg',
+                               options={'maxiter': max_iter, 'gtol': gtol})
+
+    theta = result.x
+    log_l = -(result.fun - 0.5 * penalty @ theta**2) * total
+    return JointFit(data['teams'], np.exp(theta[:n]), np.exp(theta[n:2 * n]), competitions,
+                    dict(zip(competitions, np.exp(theta[2 * n:]))), rho, log_l, result.nit,
+                    time.perf_counter() - start)
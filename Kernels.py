@@ -0,0 +1,153 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+"""
+-------------------------------------------------------------------------------------------------------------------
+Likelihood + gradient kernels over encoded match arrays (see TeamStrength.encode_matches).
+
+Every kernel computes the same thing as log_likelihood and find_gradient_vector in TeamStrength, in one pass:
+the decayed log likelihood including tau, and the partial derivatives with respect to gamma, a and b. Like
+find_gradient_vector the rho partial is left at zero. Gradients are written into preallocated arrays, so repeated
+calls from maximize, bootstraps or simulations do not allocate on the compiled path.
+"""
+
+
+def numpy_kernel(home, away, x, y, w, gamma, rho, a, b, grad_a, grad_b):
+    """
+    :return: (log likelihood, partial derivative with respect to gamma). grad_a and grad_b are overwritten.
+    """
+    ai, aj = a[home], a[away]
+    bi, bj = b[home], b[away]
+    lamb = ai * bj * gamma
+    mu = aj * bi
+
+    tau = np.ones_like(lamb)
+    low = (x <= 1) & (y <= 1)
+    if low.any():
+        tau[(x == 0) & (y == 0)] = (1 - lamb * mu * rho)[(x == 0) & (y == 0)]
+        tau[(x == 0) & (y == 1)] = (1 + lamb * rho)[(x == 0) & (y == 1)]
+        tau[(x == 1) & (y == 0)] = (1 + mu * rho)[(x == 1) & (y == 0)]
+        tau[(x == 1) & (y == 1)] = 1 - rho
+
+    log_l = np.sum(w * (np.log(tau) - lamb + x * np.log(lamb) - mu + y * np.log(mu)))
+
+    n = len(a)
+    grad_a[:] = np.bincount(home, w * (x / ai - bj * gamma), n) + np.bincount(away, w * (y / aj - bi), n)
+    grad_b[:] = np.bincount(home, w * (y / bi - aj), n) + np.bincount(away, w * (x / bj - ai * gamma), n)
+    grad_gamma = np.sum(w * (x / gamma - ai * bj))
+    return log_l, grad_gamma
+
+
+def _fused_kernel(home, away, x, y, w, gamma, rho, a, b, grad_a, grad_b):
+    grad_a[:] = 0.0
+    grad_b[:] = 0.0
+    log_l = 0.0
+    grad_gamma = 0.0
+    for k in range(home.shape[0]):
+        i = home[k]
+        j = away[k]
+        ai, aj, bi, bj = a[i], a[j], b[i], b[j]
+        xk, yk, wk = x[k], y[k], w[k]
+        lamb = ai * bj * gamma
+        mu = aj * bi
+
+        if xk == 0 and yk == 0:
+            tau = 1 - lamb * mu * rho
+        elif xk == 0 and yk == 1:
+            tau = 1 + lamb * rho
+        elif xk == 1 and yk == 0:
+            tau = 1 + mu * rho
+        elif xk == 1 and yk == 1:
+            tau = 1 - rho
+        else:
+            tau = 1.0
+
+        log_l += wk * (np.log(tau) - lamb + xk * np.log(lamb) - mu + yk * np.log(mu))
+        grad_a[i] += wk * (xk / ai - bj * gamma)
+        grad_b[i] += wk * (yk / bi - aj)
+        grad_a[j] += wk * (yk / aj - bi)
+        grad_b[j] += wk * (xk / bj - ai * gamma)
+        grad_gamma += wk * (xk / gamma - ai * bj)
+    return log_l, grad_gamma
+
+
+numba_kernel = numba.njit(cache=True, nogil=True)(_fused_kernel) if numba is not None else None
+
+BACKENDS = {'numpy': numpy_kernel}
+if numba_kernel is not None:
+    BACKENDS['numba'] = numba_kernel
+
+
+def get_kernel(backend='auto'):
+    """
+    :param backend: 'numba', 'numpy' or 'auto', which picks numba when it is installed.
+    :return: Kernel function with the signature of numpy_kernel.
+    """
+    if backend == 'auto':
+        backend = 'numba' if 'numba' in BACKENDS else 'numpy'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown or unavailable backend {backend!r}, available: {', '.join(BACKENDS)}")
+    return BACKENDS[backend]
+
+
+def evaluate(data, parameters, backend='auto'):
+    """
+    Evaluates a kernel on encoded match data with parameters in the nested maximize format.
+
+    :return: (log likelihood, gradient vector in the format of find_gradient_vector)
+    """
+    teams = data['teams']
+    a = np.array([parameters[2][team]['a'] for team in teams], dtype=np.float64)
+    b = np.array([parameters[2][team]['b'] for team in teams], dtype=np.float64)
+    grad_a, grad_b = np.empty_like(a), np.empty_like(b)
+
+    log_l, grad_gamma = get_kernel(backend)(data['home'], data['away'], data['x'], data['y'], data['w'],
+                                            float(parameters[0]), float(parameters[1]), a, b, grad_a, grad_b)
+    gradient = [grad_gamma, 0, {team: {'pd_a': grad_a[i], 'pd_b': grad_b[i]} for i, team in enumerate(teams)}]
+    return log_l, gradient
+
+
+def check_parity(seeds=(0, 1, 2), rtol=1e-9):
+    """
+    Checks every available backend against the reference log_likelihood and find_gradient_vector of TeamStrength,
+    on synthetic leagues with random parameters and with a few exact low scores so tau is exercised.
+
+    :return: True if every backend agrees within rtol.
+    """
+    import Benchmark
+    import TeamStrength
+
+    passed = True
+    for seed in seeds:
+        league = Benchmark.generate_league(n_teams=8, n_seasons=1, seed=seed)
+        matches = league['matches']
+        matches.loc[:3, ['xG', 'xGA']] = [[0, 0], [0, 1], [1, 0], [1, 1]]
+
+        rng = np.random.default_rng(seed)
+        parameters = [1 + rng.random() / 2, rng.random() / 10,
+                      {team: {'a': 0.5 + rng.random(), 'b': 0.5 + rng.random()} for team in league['truth'][2]}]
+
+        reference_ll = TeamStrength.log_likelihood(matches, parameters)
+        reference_grad = TeamStrength.find_gradient_vector(matches, parameters)
+        data = TeamStrength.encode_matches(matches)
+
+        for backend in BACKENDS:
+            log_l, gradient = evaluate(data, parameters, backend)
+            ok = np.isclose(log_l, reference_ll, rtol=rtol) and np.isclose(gradient[0], reference_grad[0], rtol=rtol)
+            for team in data['teams']:
+                for key in ('pd_a', 'pd_b'):
+                    ok = ok and np.isclose(gradient[2][team][key], reference_grad[2][team][key], rtol=rtol,
+                                           atol=1e-12)
+            print(f"seed {seed} {backend:<6} {'ok' if ok else 'MISMATCH'}")
+            passed = passed and ok
+    return passed
+
+
+if __name__ == '__main__':
+    # Parity check of all available backends against the reference implementation.
+    raise SystemExit(0 if check_parity() else 1)
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+
+# File layout: MAGIC, version and header length (uint32 each, little endian), the JSON header, zero padding up to a
+# multiple of ALIGNMENT, and then the float64 parameter block [gamma, rho, a_1..a_n, b_1..b_n].
+MAGIC = b'TSMODEL\0'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sII')
+
+# Columns of the match data the fit reads, and therefore the ones that go into the data hash. The fit also reads
+# the optional Weight column (see TeamStrength.encode_matches), which is hashed whenever it is present.
+FIT_COLUMNS = ['Date', 'H', 'A', 'xG', 'xGA']
+
+
+def data_hash(match_data):
+    """
+    :return: sha256 hex digest of the match data columns the fit uses.
+    """
+    columns = FIT_COLUMNS + (['Weight'] if 'Weight' in match_data else [])
+    frame = match_data[columns].reset_index(drop=True)
+    hashes = pd.util.hash_pandas_object(frame, index=False).values
+    digest = hashlib.sha256(hashes.tobytes())
+    digest.update(','.join(columns).encode())
+    return digest.hexdigest()
+
+
+def ratings_table(parameters, errors=None):
+    """
+    Converts maximize output to the format of Team Ratings.csv.
+
+    :param errors: Standard errors in the same format, see TeamStrength.standard_errors, added as the columns
+                   Attacking SE and Defensive SE.
+    """
+    team_parameters = parameters[2]
+    table = pd.DataFrame({
+        'Team': list(team_parameters),
+        'Attacking Strength': [team_parameters[team]['a'] for team in team_parameters],
+        'Defensive Strength': [team_parameters[team]['b'] for team in team_parameters],
+        'HFA': parameters[0]
+    })
+    if errors is not None:
+        table['Attacking SE'] = [errors[2][team]['a'] for team in team_parameters]
+        table['Defensive SE'] = [errors[2][team]['b'] for team in team_parameters]
+    return table
+
+
+class ModelArtifact:
+    """
+    A fitted model: parameters as arrays indexed like self.teams, plus what it was fitted on and how.
+    """
+    def __init__(self, teams, gamma, rho, a, b, data_hash=None, hyperparameters=None, metadata=None):
+        self.teams = list(teams)
+        self.gamma = float(gamma)
+        self.rho = float(rho)
+        self.a = a
+        self.b = b
+        self.data_hash = data_hash
+        self.hyperparameters = hyperparameters if hyperparameters is not None else {}
+        self.metadata = metadata if metadata is not None else {}
+        self.index = {team: i for i, team in enumerate(self.teams)}
+
+    @classmethod
+    def from_parameters(cls, parameters, data_hash=None, hyperparameters=None, metadata=None):
+        """
+        :param parameters: [gamma, rho, {team: {'a', 'b'}}] as returned by TeamStrength.maximize.
+        """
+        teams = list(parameters[2])
+        a = np.array([parameters[2][team]['a'] for team in teams], dtype=np.float64)
+        b = np.array([parameters[2][team]['b'] for team in teams], dtype=np.float64)
+        return cls(teams, parameters[0], parameters[1], a, b, data_hash, hyperparameters, metadata)
+
+    def parameters(self):
+        """
+        :return: The parameters in the nested format of TeamStrength.maximize.
+        """
+        return [self.gamma, self.rho,
+                {team: {'a': float(self.a[i]), 'b': float(self.b[i])} for i, team in enumerate(self.teams)}]
+
+    def ratings_table(self):
+        """
+        :return: DataFrame in the format of Team Ratings.csv, with the Attacking SE and Defensive SE columns if the
+                 artifact has standard errors.
+        """
+        table = pd.DataFrame({
+            'Team': self.teams,
+            'Attacking Strength': np.asarray(self.a),
+            'Defensive Strength': np.asarray(self.b),
+            'HFA': self.gamma
+        })
+        if 'standard_errors' in self.metadata:
+            errors = self.metadata['standard_errors']
+            table['Attacking SE'] = np.array(errors['a'], dtype=float)
+            table['Defensive SE'] = np.array(errors['b'], dtype=float)
+        return table
+
+    def save(self, path):
+        header = json.dumps({
+            'teams': self.teams,
+            'data_hash': self.data_hash,
+            'hyperparameters': self.hyperparameters,
+            'metadata': self.metadata
+        }).encode('utf-8')
+        offset = -(-(_PREAMBLE.size + len(header)) // ALIGNMENT) * ALIGNMENT
+        block = np.concatenate([[self.gamma, self.rho], self.a, self.b]).astype('<f8')
+
+        # Written to a temporary file first, so a reader never maps a half written artifact.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            f.write(b'\0' * (offset - _PREAMBLE.size - len(header)))
+            f.write(block.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an artifact, memory mapping the parameter block instead of reading it.
+        """
+        with open(path, 'rb') as f:
+            magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a model artifact")
+            if version > FORMAT_VERSION:
+                raise ValueError(f"{path} has format version {version}, only {FORMAT_VERSION} is supported")
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        n = len(header['teams'])
+        offset = -(-(_PREAMBLE.size + header_length) // ALIGNMENT) * ALIGNMENT
+        block = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(2 + 2 * n,))
+        return cls(header['teams'], block[0], block[1], block[2:2 + n], block[2 + n:], header['data_hash'],
+                   header['hyperparameters'], header['metadata'])
+
+
+def _finite(value):
+    return float(value) if np.isfinite(value) else None
+
+
+def cache_key(match_hash, hyperparameters):
+    payload = json.dumps({'data': match_hash, 'hyperparameters': hyperparameters}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+def fit_artifact(match_data, max_steps=300, learning_rate=0.003, today=None, hyperparameters=None):
+    """
+    Fits the model and packs the parameters, their standard errors and what they were fitted on into an artifact.
+    Raises ValueError if the fit diverged.
+
+    :param today: Date the decay weights are relative to, defaults to now.
+    :param hyperparameters: Stored in the artifact, defaults to max_steps and learning_rate.
+    :return: ModelArtifact
+    """
+    # Imported here, so reading artifacts (FDR, TeamVis, the server) does not pay for the fitting code.
+    import TeamStrength
+
+    if hyperparameters is None:
+        hyperparameters = {'max_steps': max_steps, 'learning_rate': learning_rate}
+
+    start = time.perf_counter()
+    parameters = TeamStrength.maximize(match_data, max_steps=max_steps, learning_rate=learning_rate, today=today)
+    values = [parameters[0]] + [team[key] for team in parameters[2].values() for key in ('a', 'b')]
+    if not np.all(np.isfinite(values)):
+        # A diverged fit must not end up in a cache, where it would be served until the data changes.
+        raise ValueError(f"The fit diverged with learning_rate={learning_rate}, try a smaller one")
+    errors = TeamStrength.standard_errors(match_data, parameters, today=today)[0]
+    metadata = {
+        'fitted_at': datetime.now().isoformat(timespec='seconds'),
+        'fit_seconds': time.perf_counter() - start,
+        'matches': len(match_data),
+        'first_match': str(match_data['Date'].min()),
+        'last_match': str(match_data['Date'].max()),
+        # Team order of parameters, nan (no information) stored as null.
+        'standard_errors': {
+            'gamma': _finite(errors[0]),
+            'rho': _finite(errors[1]),
+            'a': [_finite(errors[2][team]['a']) for team in parameters[2]],
+            'b': [_finite(errors[2][team]['b']) for team in parameters[2]]
+        }
+    }
+    return ModelArtifact.from_parameters(parameters, data_hash(match_data), hyperparameters, metadata)
+
+
+def fit_cached(match_data, cache_dir='model_cache', max_steps=300, learning_rate=0.003):
+    """
+    Fits the model, or loads the artifact of an earlier fit on the same data with the same hyperparameters.
+
+    The decay weights depend on today's date, so the date is part of the hyperparameters: the same data is refitted
+    at most once a day.
+
+    :return: ModelArtifact
+    """
+    hyperparameters = {
+        'max_steps': max_steps,
+        'learning_rate': learning_rate,
+        'reference_date': datetime.today().strftime("%Y-%m-%d")
+    }
+    match_hash = data_hash(match_data)
+    path = os.path.join(cache_dir, f"{cache_key(match_hash, hyperparameters)}.tsm")
+    if os.path.exists(path):
+        return ModelArtifact.load(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fit_artifact(match_data, max_steps, learning_rate, hyperparameters=hyperparameters).save(path)
+    return ModelArtifact.load(path)
+
+
+if __name__ == '__main__':
+    match_logs = pd.read_csv('data.csv')
+    model = fit_cached(match_logs)
+    model.save('model.tsm')
+    print(model.ratings_table())
@@ -0,0 +1,277 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from ModelArtifact import ModelArtifact
+
+
+def default_refit(history, competition=None):
+    """
+    Full refit used for reconciliation: the sparse joint fit on all matches seen so far.
+
+    :param competition: Competition whose home field advantage is returned, needed when the history has a Comp
+                        column with more than one competition.
+    :return: (teams, a, b, gamma)
+    """
+    import JointModel
+
+    fit = JointModel.fit_joint(history)
+    if competition not in fit.hfa:
+        if len(fit.competitions) > 1:
+            raise ValueError(f"Which competition's HFA to use? One of {', '.join(fit.competitions)}")
+        competition = fit.competitions[0]
+    return fit.teams, fit.a, fit.b, fit.hfa[competition]
+
+
+class OnlineRatings:
+    """
+    Ratings that move with every published result between full refits.
+
+    Each incoming match takes one natural gradient step on the TeamStrength likelihood, touching only the two teams
+    involved plus gamma and rho, so an update is O(1). In log space the Fisher information of a Poisson mean is the
+    mean itself, so the natural gradient step on log(lamb) is simply (x - lamb) / lamb, i.e. the relative surprise,
+    which makes the step size independent of how many goals the teams usually score.
+
+    Step sizes decay with the number of updates a team has had since the last reconciliation, down to a floor so
+    ratings keep tracking form. Every reconcile_every matches the ratings are replaced by a full refit on the match
+    history, which keeps the drift of the online approximation bounded.
+    """
+    def __init__(self, teams, a, b, gamma, rho=0.1, learning_rate=0.1, min_rate=0.02, halflife=10,
+                 global_rate=0.005, reconcile_every=None, refit=default_refit, history=None, competition=None):
+        """
+        :param teams: Team names, in the order of a and b.
+        :param a: Attacking strengths.
+        :param b: Defensive strengths.
+        :param gamma: Home field advantage.
+        :param rho: Low score dependence.
+        :param learning_rate: Step size of a team's first update.
+        :param min_rate: Floor of the decayed step size.
+        :param halflife: Number of updates after which a team's step size has halved.
+        :param global_rate: Step size of gamma and rho, which every match updates.
+        :param reconcile_every: Refit after this many matches, never if None.
+        :param refit: Function from the match history DataFrame and the competition to (teams, a, b, gamma).
+        :param history: DataFrame of the matches the ratings were fitted on, extended with every update. Required
+                        with reconcile_every, a refit on the streamed matches alone would replace the fitted ratings
+                        with a fit on far less data.
+        :param competition: Competition whose home field advantage gamma is, when the history has a Comp column.
+                            Defaults to its most common competition. Only matches of it update gamma.
+        """
+        if reconcile_every is not None and history is None:
+            raise ValueError("reconcile_every needs the history the ratings were fitted on")
+
+        self.teams = list(teams)
+        self.index = {team: i for i, team in enumerate(self.teams)}
+        self.log_a = np.log(np.asarray(a, dtype=float))
+        self.log_b = np.log(np.asarray(b, dtype=float))
+        self.log_gamma = np.log(gamma)
+        self.rho = rho
+        self.updates = np.zeros(len(self.teams), dtype=int)
+
+        self.learning_rate = learning_rate
+        self.min_rate = min_rate
+        self.halflife = halflife
+        self.global_rate = global_rate
+
+        self.reconcile_every = reconcile_every
+        self.refit = refit
+        self.history = [] if history is None else history.to_dict('records')
+        # Streamed matches get the same columns as the history, so the refit can read them.
+        self.columns = [] if history is None else list(history.columns)
+        if competition is None and 'Comp' in self.columns and len(history):
+            competition = history['Comp'].mode()[0]
+        self.competition = competition
+        self.since_reconcile = 0
+        self.drift = []
+
+    @classmethod
+    def from_artifact(cls, model, history=None, **kwargs):
+        """
+        :param model: ModelArtifact
+        :param history: DataFrame of the matches the artifact was fitted on.
+        """
+        return cls(model.teams, np.asarray(model.a), np.asarray(model.b), model.gamma, model.rho, history=history,
+                   **kwargs)
+
+    @classmethod
+    def from_parameters(cls, parameters, history=None, **kwargs):
+        """
+        :param parameters: [gamma, rho, {team: {'a', 'b'}}] as returned by TeamStrength.maximize.
+        :param history: DataFrame of the matches the parameters were fitted on.
+        """
+        teams = list(parameters[2])
+        a = [parameters[2][team]['a'] for team in teams]
+        b = [parameters[2][team]['b'] for team in teams]
+        return cls(teams, a, b, parameters[0], parameters[1], history=history, **kwargs)
+
+    def team_index(self, team):
+        """
+        :return: Index of the team, adding it with average strength if it has not been seen before.
+        """
+        if team not in self.index:
+            self.index[team] = len(self.teams)
+            self.teams.append(team)
+            self.log_a = np.append(self.log_a, self.log_a.mean())
+            self.log_b = np.append(self.log_b, self.log_b.mean())
+            self.updates = np.append(self.updates, 0)
+        return self.index[team]
+
+    def rate(self, i):
+        return max(self.min_rate, self.learning_rate / (1 + self.updates[i] / self.halflife))
+
+    def update(self, home, away, x, y, date=None, competition=None):
+        """
+        Takes one natural gradient step for a single result.
+
+        :param home: Home team name.
+        :param away: Away team name.
+        :param x: Home xG.
+        :param y: Away xG.
+        :param date: Match date ("%Y-%m-%d"), kept in the history for reconciliation, defaults to today.
+        :param competition: Competition of the match, defaults to the tracked one. Matches of other competitions
+                            update the teams but not gamma, which is the HFA of the tracked competition.
+        :return: Dict of the updated parameters of both teams, gamma and rho.
+        """
+        if competition is None:
+            competition = self.competition
+        i, j = self.team_index(home), self.team_index(away)
+        lamb = np.exp(self.log_a[i] + self.log_b[j] + self.log_gamma)
+        mu = np.exp(self.log_a[j] + self.log_b[i])
+
+        # Natural gradient steps on log(lamb) and log(mu).
+        step_x = (x - lamb) / lamb
+        step_y = (y - mu) / mu
+        rate_i, rate_j = self.rate(i), self.rate(j)
+
+        self.log_a[i] += rate_i * step_x
+        self.log_b[i] += rate_i * step_y
+        self.log_a[j] += rate_j * step_y
+        self.log_b[j] += rate_j * step_x
+        if self.competition is None or competition == self.competition:
+            self.log_gamma += self.global_rate * step_x
+        self.rho += self.global_rate * self.rho_gradient(x, y, lamb, mu)
+        self.updates[i] += 1
+        self.updates[j] += 1
+
+        if date is None:
+            date = datetime.today().strftime("%Y-%m-%d")
+        row = {'Date': date, 'H': home, 'A': away, 'xG': x, 'xGA': y}
+        if 'Comp' in self.columns:
+            row['Comp'] = competition
+        if 'Weight' in self.columns:
+            # Weight only differs from 1 for folded rows, see TeamStrength.load_match_logs.
+            row['Weight'] = 1.0
+        self.history.append(row)
+        self.since_reconcile += 1
+        if self.reconcile_every is not None and self.since_reconcile >= self.reconcile_every:
+            self.reconcile()
+
+        return {
+            home: {'a': np.exp(self.log_a[i]), 'b': np.exp(self.log_b[i])},
+            away: {'a': np.exp(self.log_a[j]), 'b': np.exp(self.log_b[j])},
+            'gamma': np.exp(self.log_gamma),
+            'rho': self.rho
+        }
+
+    def rho_gradient(self, x, y, lamb, mu):
+        """
+        :return: Partial derivative of log(tau) with respect to rho, zero unless the result is low scoring.
+        """
+        if x == y == 0:
+            return -lamb * mu / (1 - lamb * mu * self.rho)
+        elif x == 0 and y == 1:
+            return lamb / (1 + lamb * self.rho)
+        elif x == 1 and y == 0:
+            return mu / (1 + mu * self.rho)
+        elif x == y == 1:
+            return -1 / (1 - self.rho)
+        return 0
+
+    def stream(self, results):
+        """
+        Updates the ratings with a stream of results.
+
+        :param results: Iterable of dicts (or a DataFrame) with keys Date, H, A, xG, xGA and optionally Comp.
+        :return: Generator of (result, updated parameters).
+        """
+        if isinstance(results, pd.DataFrame):
+            results = results.to_dict('records')
+        for result in results:
+            yield result, self.update(result['H'], result['A'], result['xG'], result['xGA'], result.get('Date'),
+                                      result.get('Comp'))
+
+    def reconcile(self):
+        """
+        Replaces the online ratings by a full refit on the history and records how far they had drifted: the
+        largest difference in log expected goals against an average opponent.
+        """
+        teams, a, b, gamma = self.refit(pd.DataFrame(self.history), self.competition)
+        refit_index = [self.team_index(team) for team in teams]
+
+        old_a, old_b = self.log_a[refit_index], self.log_b[refit_index]
+        new_a, new_b = np.log(a), np.log(b)
+        # Only products a_i b_j are identified, so both sides are centred before comparing.
+        drift = max(np.abs((old_a - old_a.mean()) - (new_a - new_a.mean())).max(),
+                    np.abs((old_b - old_b.mean()) - (new_b - new_b.mean())).max())
+        self.drift.append(drift)
+
+        self.log_a[refit_index] = new_a
+        self.log_b[refit_index] = new_b
+        self.log_gamma = np.log(gamma)
+        self.updates[:] = 0
+        self.since_reconcile = 0
+
+    def parameters(self):
+        """
+        :return: The ratings in the nested format of TeamStrength.maximize.
+        """
+        return [np.exp(self.log_gamma), self.rho,
+                {team: {'a': np.exp(self.log_a[i]), 'b': np.exp(self.log_b[i])} for i, team in enumerate(self.teams)}]
+
+    def to_artifact(self):
+        return ModelArtifact(self.teams, np.exp(self.log_gamma), self.rho, np.exp(self.log_a), np.exp(self.log_b),
+                             metadata={'online_updates': len(self.history)})
+
+
+def check_reconcile(n_teams=60, n_matches=4000, n_stream=300, reconcile_every=100, epsilon=0.3, seed=0):
+    """
+    Streams results onto a history with Comp and Weight columns, as JointModel and a folded
+    TeamStrength.load_match_logs produce, and checks that every reconciliation runs and that the last one sets gamma
+    to the HFA of the tracked competition in a full refit.
+
+    :return: True if every check passes.
+    """
+    import os
+    import tempfile
+    import Benchmark
+    import JointModel
+    from TeamStrength import load_match_logs
+
+    matches = Benchmark.generate_joint(n_teams, n_matches, seed=seed)['matches'].sort_values('Date', kind='stable')
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'matches.csv')
+        matches.iloc[:-n_stream].to_csv(path, index=False)
+        history, report = load_match_logs(path, epsilon=epsilon, fold=True)
+    results = matches.iloc[-n_stream:]
+
+    competition = 'Division 1'
+    fit = JointModel.fit_joint(history)
+    ratings = OnlineRatings(fit.teams, fit.a, fit.b, fit.hfa[competition], history=history,
+                            reconcile_every=reconcile_every, competition=competition)
+    for _ in ratings.stream(results):
+        pass
+
+    full = pd.DataFrame(ratings.history)
+    expected = JointModel.fit_joint(full).hfa[competition]
+    checks = {
+        'folded rows': report.get('folded_rows', 0) > 0,
+        'reconciled': len(ratings.drift) == n_stream // reconcile_every,
+        'history filled': not full[['Comp', 'Weight']].isna().any().any(),
+        'gamma': np.isclose(np.exp(ratings.log_gamma), expected, rtol=1e-6)
+    }
+    for name, ok in checks.items():
+        print(f"{name:<15} {'ok' if ok else 'FAILED'}")
+    return all(checks.values())
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if check_reconcile() else 1)
@@ -0,0 +1,283 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import pandas as pd
+
+"""
+-------------------------------------------------------------------------------------------------------------------
+Scrape -> fit -> predict -> render as one command.
+
+Every stage declares the files it reads and writes. A stage's key is a hash of its function, its parameters and the
+contents of its input files, and a stage is skipped when its key and its outputs are unchanged since the last run. So
+a new scrape that brings no new results refits nothing, and a new result refits and re-renders only that league.
+Stages whose inputs are ready run concurrently in a process pool, e.g. the fits of different leagues, and the
+predictions and charts of a league once its fit is done.
+"""
+
+PREMIER_LEAGUE = 'https://fbref.com/en/comps/9/schedule/Premier-League-Scores-and-Fixtures'
+
+
+class Stage:
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, volatile=False):
+        """
+        :param name: Unique name, e.g. "fit:Premier League".
+        :param func: Top level function (it runs in a worker process), called with params as keyword arguments.
+        :param inputs: Paths of the files the stage reads, the outputs of other stages or files on disk.
+        :param outputs: Paths of the files the stage writes.
+        :param params: Dict of JSON serializable keyword arguments, part of the key.
+        :param volatile: The stage reads something that cannot be hashed (the web), so it always runs. Its
+                         outputs are still hashed, so later stages only rerun if it produced something new.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params if params is not None else {}
+        self.volatile = volatile
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _run_stage(func, params):
+    start = time.perf_counter()
+    func(**params)
+    return time.perf_counter() - start
+
+
+class Pipeline:
+    def __init__(self, stages, state_path='pipeline/state.json', workers=None):
+        """
+        :param stages: List of Stage, in any order, dependencies are found from inputs and outputs.
+        :param state_path: JSON file with the key and output hashes of every stage's last run.
+        :param workers: Number of processes.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.workers = workers
+
+        producers = {path: stage.name for stage in stages for path in stage.outputs}
+        self.dependencies = {stage.name: {producers[path] for path in stage.inputs if path in producers}
+                             for stage in stages}
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def key(self, stage):
+        payload = {
+            'func': f"{stage.func.__module__}.{stage.func.__qualname__}",
+            'params': stage.params,
+            'inputs': {path: file_hash(path) for path in stage.inputs}
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def up_to_date(self, stage, key, state):
+        last = state.get(stage.name)
+        if stage.volatile or last is None or last['key'] != key:
+            return False
+        return all(os.path.exists(path) and file_hash(path) == last['outputs'].get(path) for path in stage.outputs)
+
+    def run(self, force=()):
+        """
+        Runs every stage that is out of date, as soon as the stages it depends on are done.
+
+        :param force: Names of stages to run even if they are up to date.
+        :return: DataFrame with the status (ran, skipped, failed or blocked) and seconds of every stage.
+        """
+        state = self.load_state()
+        pending = dict(self.stages)
+        done, broken = set(), set()
+        summary = {}
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if self.dependencies[name] & broken:
+                        del pending[name]
+                        broken.add(name)
+                        summary[name] = ('blocked', 0.0)
+                    elif self.dependencies[name] <= done:
+                        del pending[name]
+                        missing = [path for path in stage.inputs if not os.path.exists(path)]
+                        if missing:
+                            print(f"{name}: missing input {', '.join(missing)}")
+                            broken.add(name)
+                            summary[name] = ('failed', 0.0)
+                            continue
+                        key = self.key(stage)
+                        if name not in force and self.up_to_date(stage, key, state):
+                            done.add(name)
+                            summary[name] = ('skipped', 0.0)
+                            continue
+                        running[pool.submit(_run_stage, stage.func, stage.params)] = (stage, key)
+
+                if not running:
+                    # Skipping or blocking a stage may have made others ready.
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, key = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception as error:
+                        print(f"{stage.name} failed: {error!r}")
+                        broken.add(stage.name)
+                        summary[stage.name] = ('failed', 0.0)
+                        continue
+                    state[stage.name] = {'key': key, 'outputs': {path: file_hash(path) for path in stage.outputs}}
+                    self.save_state(state)
+                    done.add(stage.name)
+                    summary[stage.name] = ('ran', seconds)
+
+        return pd.DataFrame([(name,) + summary[name] for name in self.stages], columns=['Stage', 'Status', 'Seconds'])
+
+
+def scrape_matches(source, matches, fixtures):
+    """
+    Writes the played matches (Date, H, A, xG, xGA, HG, AG) and the unplayed fixtures (Date, H, A) of a league.
+
+    :param source: URL of an FBref "Scores & Fixtures" page, or a CSV in the data.csv format.
+    :param matches: Path of the played matches CSV.
+    :param fixtures: Path of the fixtures CSV.
+    """
+    if source.endswith('.csv'):
+        data = pd.read_csv(source)
+        played = data.loc[data['xG'].notna()]
+        upcoming = data.loc[data['xG'].isna(), ['Date', 'H', 'A']]
+    else:
+        from DataScraper import fetch_page, find_tables, parse_table
+
+        tables = [table_html for table_id, table_html in find_tables(fetch_page(source)).items()
+                  if table_id.startswith('sched')]
+        if not tables:
+            raise ValueError(f"No schedule table on {source}")
+        table = parse_table(tables[0])
+        table = table.loc[table['Date'].astype(str).str.match(r'\d{4}-\d{2}-\d{2}')]
+
+        data = pd.DataFrame({'Date': table['Date'], 'H': table['Home'].str.strip(), 'A': table['Away'].str.strip(),
+                             'xG': table['xG'], 'xGA': table['xG.1']})
+        goals = table['Score'].astype(str).str.extract(r'(\d+)\D+(\d+)').astype(float)
+        data['HG'], data['AG'] = goals[0].values, goals[1].values
+        played = data.loc[data['xG'].notna() & data['HG'].notna()]
+        upcoming = data.loc[data['HG'].isna(), ['Date', 'H', 'A']]
+
+    for path in (matches, fixtures):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    played.to_csv(matches, index=False)
+    upcoming.to_csv(fixtures, index=False)
+
+
+def fit_model(matches, model, max_steps=300, learning_rate=0.003, reference_date=None):
+    """
+    Fits the model on the played matches and saves it as an artifact, with standard errors.
+
+    :param reference_date: Date the decay weights are relative to, part of the stage key so a league is refitted
+                           at most once a day when no new results come in.
+    """
+    from ModelArtifact import fit_artifact
+
+    match_data = pd.read_csv(matches)
+    hyperparameters = {'max_steps': max_steps, 'learning_rate': learning_rate, 'reference_date': reference_date}
+    fit_artifact(match_data, max_steps, learning_rate, today=reference_date, hyperparameters=hyperparameters).save(model)
+
+
+def write_predictions(model, fixtures, predictions):
+    """
+    Writes expected goals and result probabilities of every fixture between teams the model knows.
+    """
+    from ModelArtifact import ModelArtifact
+    from Prediction import predict_fixtures
+
+    artifact = ModelArtifact.load(model)
+    table = pd.read_csv(fixtures)
+    table = table.loc[table['H'].isin(artifact.index) & table['A'].isin(artifact.index)]
+    for column, values in predict_fixtures(artifact, table['H'].values, table['A'].values).items():
+        table[column] = values
+    table.to_csv(predictions, index=False)
+
+
+def render_charts(model, league, date, out_dir, aspects, short_names=None):
+    from TeamVis import render_job
+
+    render_job({'league': league, 'date': date, 'model': model, 'out_dir': out_dir, 'aspects': aspects,
+                'short_names': short_names, 'intervals': True})
+
+
+def league_stages(league, source, out_dir='pipeline', reference_date=None, max_steps=300, learning_rate=0.003,
+                  aspects=('o', 'a', 'd', 'wr'), short_names='short_names.csv'):
+    """
+    :param league: League name, used in the stage names and paths.
+    :param source: FBref "Scores & Fixtures" URL or data.csv style file, see scrape_matches.
+    :return: The scrape, fit, predict and render stages of one league.
+    """
+    reference_date = reference_date or datetime.today().strftime("%Y-%m-%d")
+    folder = os.path.join(out_dir, re.sub(r'\W+', '_', league))
+    matches = os.path.join(folder, 'matches.csv')
+    fixtures = os.path.join(folder, 'fixtures.csv')
+    model = os.path.join(folder, 'model.tsm')
+    predictions = os.path.join(folder, 'predictions.csv')
+    charts = os.path.join(folder, 'charts')
+    # The file names render_job writes.
+    stem = f"{league}_{reference_date}".replace(' ', '_')
+    chart_paths = [os.path.join(charts, f"{stem}_{aspect}.png") for aspect in aspects]
+
+    local = not source.startswith('http')
+    short_inputs = [short_names] if short_names and os.path.exists(short_names) else []
+    return [
+        Stage(f"scrape:{league}", scrape_matches, inputs=[source] if local else [], outputs=[matches, fixtures],
+              params={'source': source, 'matches': matches, 'fixtures': fixtures}, volatile=not local),
+        Stage(f"fit:{league}", fit_model, inputs=[matches], outputs=[model],
+              params={'matches': matches, 'model': model, 'max_steps': max_steps, 'learning_rate': learning_rate,
+                      'reference_date': reference_date}),
+        Stage(f"predict:{league}", write_predictions, inputs=[model, fixtures], outputs=[predictions],
+              params={'model': model, 'fixtures': fixtures, 'predictions': predictions}),
+        Stage(f"render:{league}", render_charts, inputs=[model] + short_inputs, outputs=chart_paths,
+              params={'model': model, 'league': league, 'date': reference_date, 'out_dir': charts,
+                      'aspects': list(aspects), 'short_names': short_inputs[0] if short_inputs else None})
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape, fit, predict and render, rerunning only what changed.")
+    parser.add_argument('--league', action='append', metavar='NAME=SOURCE',
+                        help="League name and FBref Scores & Fixtures URL or data.csv style file, repeatable. "
+                             "Defaults to the Premier League.")
+    parser.add_argument('--out', default='pipeline', help="Folder of all stage outputs.")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=300)
+    parser.add_argument('--learning-rate', type=float, default=0.003)
+    parser.add_argument('--force', action='append', default=[], help="Stage to run even if it is up to date.")
+    args = parser.parse_args()
+
+    leagues = [league.split('=', 1) for league in args.league] if args.league else [('Premier League', PREMIER_LEAGUE)]
+    stages = [stage for name, source in leagues
+              for stage in league_stages(name, source, out_dir=args.out, max_steps=args.max_steps,
+                                         learning_rate=args.learning_rate)]
+
+    start = time.perf_counter()
+    summary = Pipeline(stages, state_path=os.path.join(args.out, 'state.json'), workers=args.workers).run(
+        force=set(args.force))
+    print(summary.to_string(index=False))
+    print(f"Pipeline took {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import time
+from itertools import combinations
+import numpy as np
+import pandas as pd
+
+METRICS = ('attack', 'defence', 'overall')
+
+
+def fixture_values(GS, GA, N, metric='attack'):
+    """
+    Turns the team x GW expected goals matrices into one value per cell where higher is better.
+
+    attack:  expected goals scored.
+    defence: expected goals prevented, i.e. the league average conceded per fixture minus GA, so a blank counts as
+             zero rather than as a perfect defensive week, and a double counts twice.
+    overall: expected goal difference.
+
+    :param GS: Expected goals scored, from FDR.expected_goals_matrix.
+    :param GA: Expected goals conceded.
+    :param N: Number of fixtures per cell.
+    :return: Array of shape (teams, GWs).
+    """
+    if metric == 'attack':
+        return GS
+    elif metric == 'defence':
+        average = GA.sum() / max(N.sum(), 1)
+        return N * average - GA
+    elif metric == 'overall':
+        return GS - GA
+    raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(METRICS)}")
+
+
+def rolling_sums(values, k):
+    """
+    Sums over every window of k consecutive GWs, via cumulative sums.
+
+    :param values: Array of shape (..., GWs).
+    :return: Array of shape (..., GWs - k + 1), entry [..., s] is the sum over GWs s..s+k-1.
+    """
+    padded = np.concatenate([np.zeros(values.shape[:-1] + (1,)), np.cumsum(values, axis=-1)], axis=-1)
+    return padded[..., k:] - padded[..., :-k]
+
+
+def check_window(n_gws, k, start=0):
+    """
+    Raises ValueError unless a window of k GWs from GW index start fits in the n_gws GWs.
+    """
+    if not 0 <= start < n_gws:
+        raise ValueError(f"start must be between 0 and {n_gws - 1}, got {start}")
+    if not 1 <= k <= n_gws - start:
+        raise ValueError(f"k must be between 1 and {n_gws - start} (the GWs left from start {start}), got {k}")
+
+
+def best_runs(teams, values, k, start=None, top=10):
+    """
+    Ranks the teams by their next k GWs.
+
+    :param teams: Team names, rows of values.
+    :param values: (teams x GWs) values from fixture_values.
+    :param k: Horizon in GWs.
+    :param start: Only windows starting at this GW index, every window if None.
+    :return: DataFrame with Team, Start (GW index of the window) and Score, best first.
+    """
+    check_window(values.shape[1], k, 0 if start is None else start)
+    sums = rolling_sums(values, k)
+    if start is not None:
+        sums = sums[:, start:start + 1]
+        offset = start
+    else:
+        offset = 0
+    t, s = np.unravel_index(np.argsort(-sums, axis=None)[:top], sums.shape)
+    return pd.DataFrame({'Team': [teams[i] for i in t], 'Start': s + offset, 'Score': sums[t, s]})
+
+
+def pair_scores(values, k):
+    """
+    Rotation value of every pair of teams: each GW the better of the two is picked, summed over every window of k.
+
+    :return: Array of shape (teams, teams, GWs - k + 1).
+    """
+    best = np.maximum(values[:, np.newaxis, :], values[np.newaxis, :, :])
+    return rolling_sums(best, k)
+
+
+def set_scores(values, k, size):
+    """
+    Rotation value of every set of size teams, as pair_scores but for any set size.
+
+    :return: (sets, scores) where sets is an array of shape (n_sets, size) of team indices and scores has shape
+             (n_sets, GWs - k + 1).
+    """
+    sets = np.array(list(combinations(range(values.shape[0]), size)), dtype=int)
+    best = values[sets].max(axis=1)
+    return sets, rolling_sums(best, k)
+
+
+def best_rotations(teams, values, k, size=2, start=0, top=10):
+    """
+    Ranks sets of teams by how well they rotate over the k GWs from start.
+
+    :return: DataFrame with Teams, Score and Coverage (what rotating gains over the best single team of the set).
+    """
+    check_window(values.shape[1], k, start)
+    if size == 2:
+        scores = pair_scores(values, k)[:, :, start]
+        i, j = np.triu_indices(len(teams), 1)
+        sets, scores = np.stack([i, j], axis=1), scores[i, j]
+    else:
+        sets, scores = set_scores(values, k, size)
+        scores = scores[:, start]
+
+    singles = rolling_sums(values, k)[:, start]
+    best_single = singles[sets].max(axis=1)
+    order = np.argsort(-scores)[:top]
+    return pd.DataFrame({
+        'Teams': [' + '.join(teams[t] for t in sets[r]) for r in order],
+        'Score': scores[order],
+        'Coverage': scores[order] - best_single[order]
+    })
+
+
+if __name__ == '__main__':
+    import FDR
+    from ModelArtifact import ModelArtifact
+
+    parser = argparse.ArgumentParser(description="Best fixture runs and team rotations over the next GWs.")
+    parser.add_argument('-k', type=int, default=5, help="Horizon in gameweeks.")
+    parser.add_argument('--metric', choices=METRICS, default='attack')
+    parser.add_argument('--size', type=int, default=1, help="1 ranks single teams, 2 or more ranks rotations.")
+    parser.add_argument('--start', type=int, default=0, help="First gameweek of the window, 0 is the next one.")
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--model', help="Model artifact to use, instead of Team Ratings.csv.")
+    args = parser.parse_args()
+
+    team_ratings = ModelArtifact.load(args.model).ratings_table() if args.model else pd.read_csv('Team Ratings.csv')
+    fixtures = FDR.get_fixtures()
+    gws, curr_gw = asyncio.run(FDR.main())
+
+    start = time.perf_counter()
+    teams, GS, GA, N = FDR.expected_goals_matrix(fixtures, team_ratings, gws)
+    values = fixture_values(GS, GA, N, args.metric)
+    try:
+        if args.size == 1:
+            ranking = best_runs(teams, values, args.k, start=args.start, top=args.top)
+            ranking['Start'] += curr_gw
+        else:
+            ranking = best_rotations(teams, values, args.k, size=args.size, start=args.start, top=args.top)
+    except ValueError as error:
+        parser.error(str(error))
+    elapsed = time.perf_counter() - start
+
+    print(f"GW{curr_gw + args.start}-GW{curr_gw + args.start + args.k - 1}, {args.metric}:")
+    print(ranking.to_string(index=False))
+    print(f"({elapsed * 1000:.1f} ms)")
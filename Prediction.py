@@ -0,0 +1,65 @@
+import numpy as np
+from scipy import stats
+
+
+def expected_goals(model, home, away):
+    """
+    Expected goals of many fixtures at once.
+
+    :param model: ModelArtifact
+    :param home: Sequence of home team names.
+    :param away: Sequence of away team names.
+    :return: (lamb, mu) arrays, expected home and away goals.
+    """
+    h = np.array([model.index[team] for team in home], dtype=int)
+    aw = np.array([model.index[team] for team in away], dtype=int)
+    a = np.asarray(model.a)
+    b = np.asarray(model.b)
+    return a[h] * b[aw] * model.gamma, a[aw] * b[h]
+
+
+def score_matrix(lamb, mu, rho, max_goals=10):
+    """
+    Scoreline probabilities of many fixtures, with the tau dependence applied to the low scoring results.
+
+    :param lamb: Array of expected home goals.
+    :param mu: Array of expected away goals.
+    :param rho: Low score dependence.
+    :param max_goals: Largest number of goals per team, the rest of the tail is dropped.
+    :return: Array of shape (n, max_goals + 1, max_goals + 1), entry [k, x, y] is P(x - y) in fixture k.
+    """
+    lamb = np.asarray(lamb, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    goals = np.arange(max_goals + 1)
+    home_pmf = stats.poisson.pmf(goals[np.newaxis, :], lamb[:, np.newaxis])
+    away_pmf = stats.poisson.pmf(goals[np.newaxis, :], mu[:, np.newaxis])
+    scores = home_pmf[:, :, np.newaxis] * away_pmf[:, np.newaxis, :]
+
+    # Same factors as TeamStrength.tau, for all fixtures at once.
+    scores[:, 0, 0] *= 1 - lamb * mu * rho
+    scores[:, 0, 1] *= 1 + lamb * rho
+    scores[:, 1, 0] *= 1 + mu * rho
+    scores[:, 1, 1] *= 1 - rho
+    return scores
+
+
+def result_probabilities(scores):
+    """
+    :param scores: Scoreline probabilities from score_matrix.
+    :return: (home win, draw, away win) probability arrays.
+    """
+    home = np.tril(np.ones(scores.shape[1:]), -1)
+    draw = np.eye(scores.shape[1])
+    away = np.triu(np.ones(scores.shape[1:]), 1)
+    return (scores * home).sum(axis=(1, 2)), (scores * draw).sum(axis=(1, 2)), (scores * away).sum(axis=(1, 2))
+
+
+def predict_fixtures(model, home, away, max_goals=10):
+    """
+    Expected goals and result probabilities of many fixtures in one vectorized pass.
+
+    :return: Dict of arrays: home_xg, away_xg, p_home, p_draw and p_away.
+    """
+    lamb, mu = expected_goals(model, home, away)
+    p_home, p_draw, p_away = result_probabilities(score_matrix(lamb, mu, model.rho, max_goals))
+    return {'home_xg': lamb, 'away_xg': mu, 'p_home': p_home, 'p_draw': p_draw, 'p_away': p_away}
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+import numpy as np
+from aiohttp import web
+
+from ModelArtifact import ModelArtifact
+from Prediction import predict_fixtures
+
+
+class UnknownTeams(Exception):
+    """
+    Raised for a queued request when the model it is predicted with does not have all of its teams, e.g. after a
+    reload removed a team.
+    """
+    def __init__(self, teams):
+        super().__init__(f"Unknown teams: {', '.join(teams)}")
+        self.teams = teams
+
+
+def unknown_teams(model, home, away):
+    return sorted(set(home + away) - set(model.index))
+
+
+class PredictionServer:
+    """
+    Long running HTTP service holding a fitted model in memory.
+
+    Concurrent requests are queued and coalesced into one vectorized prediction per batch, and the model is swapped
+    for the new one whenever the artifact file changes on disk.
+
+    POST /predict  {"fixtures": [{"home": ..., "away": ...}, ...]}
+    GET  /metrics  latency, throughput and batching statistics
+    GET  /health
+    """
+    def __init__(self, model_path, max_batch=512, max_wait=0.002, reload_interval=1.0, window=10000):
+        """
+        :param model_path: Path of the model artifact to serve.
+        :param max_batch: Largest number of fixtures predicted in one batch.
+        :param max_wait: Seconds a batch waits for more requests after the first one arrives.
+        :param reload_interval: Seconds between checks of the artifact file.
+        :param window: Number of recent requests the latency percentiles are computed over.
+        """
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.reload_interval = reload_interval
+
+        self.model = ModelArtifact.load(model_path)
+        self.model_mtime = os.stat(model_path).st_mtime_ns
+
+        self.queue = None
+        self.tasks = []
+
+        self.started = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.counts = {'requests': 0, 'fixtures': 0, 'batches': 0, 'errors': 0, 'reloads': 0}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/predict', self.handle_predict)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+    async def start(self, app):
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.batch_loop()), asyncio.create_task(self.reload_loop())]
+
+    async def stop(self, app):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def handle_predict(self, request):
+        start = time.perf_counter()
+        try:
+            body = await request.json()
+            home = [fixture['home'] for fixture in body['fixtures']]
+            away = [fixture['away'] for fixture in body['fixtures']]
+            if not all(isinstance(team, str) for team in home + away):
+                raise TypeError("Team names must be strings")
+        except (ValueError, KeyError, TypeError):
+            self.counts['errors'] += 1
+            raise web.HTTPBadRequest(text="Expected {\"fixtures\": [{\"home\": ..., \"away\": ...}, ...]} with "
+                                          "team names as strings")
+
+        unknown = unknown_teams(self.model, home, away)
+        if unknown:
+            self.counts['errors'] += 1
+            raise web.HTTPBadRequest(text=f"Unknown teams: {', '.join(unknown)}")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((home, away, future))
+        try:
+            predictions, model_hash = await future
+        except UnknownTeams as error:
+            # The model was swapped while the request was queued.
+            self.counts['errors'] += 1
+            raise web.HTTPBadRequest(text=str(error))
+        except Exception:
+            self.counts['errors'] += 1
+            raise web.HTTPInternalServerError(text="Prediction failed")
+
+        self.counts['requests'] += 1
+        self.counts['fixtures'] += len(home)
+        self.latencies.append(time.perf_counter() - start)
+        return web.json_response({'model': model_hash, 'predictions': predictions})
+
+    async def batch_loop(self):
+        """
+        Takes requests off the queue and predicts them together, waiting at most max_wait for a batch to fill up.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.predict_batch(batch)
+
+    def predict_batch(self, batch):
+        model = self.model
+        # Teams were checked against the model at the time of the request, a reload since may have removed some.
+        valid = []
+        for item in batch:
+            unknown = unknown_teams(model, item[0], item[1])
+            if not unknown:
+                valid.append(item)
+            elif not item[2].done():
+                item[2].set_exception(UnknownTeams(unknown))
+        batch = valid
+        if not batch:
+            return
+
+        home = [team for item in batch for team in item[0]]
+        away = [team for item in batch for team in item[1]]
+        try:
+            result = predict_fixtures(model, home, away)
+        except Exception as error:
+            for item in batch:
+                if not item[2].done():
+                    item[2].set_exception(error)
+            return
+
+        self.counts['batches'] += 1
+        self.batch_sizes.append(len(home))
+
+        columns = {key: values.tolist() for key, values in result.items()}
+        k = 0
+        for item_home, item_away, future in batch:
+            predictions = []
+            for i in range(k, k + len(item_home)):
+                prediction = {'home': home[i], 'away': away[i]}
+                prediction.update({key: values[i] for key, values in columns.items()})
+                predictions.append(prediction)
+            k += len(item_home)
+            if not future.done():
+                future.set_result((predictions, model.data_hash))
+
+    async def reload_loop(self):
+        """
+        Swaps in the new model whenever the artifact file is replaced.
+        """
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                mtime = os.stat(self.model_path).st_mtime_ns
+                if mtime != self.model_mtime:
+                    self.model = ModelArtifact.load(self.model_path)
+                    self.model_mtime = mtime
+                    self.counts['reloads'] += 1
+            except (OSError, ValueError):
+                # A missing or unreadable file keeps the current model in service.
+                continue
+
+    async def handle_metrics(self, request):
+        latencies = np.array(self.latencies) * 1000
+        uptime = time.perf_counter() - self.started
+        metrics = dict(self.counts)
+        metrics.update({
+            'uptime_seconds': uptime,
+            'requests_per_second': self.counts['requests'] / uptime,
+            'fixtures_per_second': self.counts['fixtures'] / uptime,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'model': self.model.data_hash
+        })
+        if len(latencies):
+            metrics.update({f'latency_p{q}_ms': float(np.percentile(latencies, q)) for q in (50, 95, 99)})
+        return web.json_response(metrics)
+
+    async def handle_health(self, request):
+        return web.json_response({'status': 'ok', 'teams': len(self.model.teams), 'model': self.model.data_hash})
+
+
+async def _check_server(folder):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    teams = [f"Team {i + 1}" for i in range(6)]
+    path = os.path.join(folder, 'model.tsm')
+    ModelArtifact(teams, 1.2, 0.1, np.linspace(0.8, 1.4, 6), np.linspace(1.2, 0.9, 6), data_hash='first').save(path)
+
+    server = PredictionServer(path, max_wait=0.05, reload_interval=0.05)
+    client = TestClient(TestServer(server.app()))
+    await client.start_server()
+    results = {}
+    try:
+        # Batching: concurrent requests are answered together.
+        responses = await asyncio.gather(*[
+            client.post('/predict', json={'fixtures': [{'home': teams[i % 6], 'away': teams[(i + 1) % 6]}]})
+            for i in range(20)])
+        bodies = [await response.json() for response in responses]
+        results['batching'] = (all(response.status == 200 for response in responses)
+                               and all(len(body['predictions']) == 1 for body in bodies)
+                               and server.counts['batches'] < 20)
+
+        # Errors: malformed bodies, non string teams and unknown teams are 400s and counted.
+        statuses = [
+            (await client.post('/predict', data='not json')).status,
+            (await client.post('/predict', json={'fixtures': [{'home': ['Team 1'], 'away': 'Team 2'}]})).status,
+            (await client.post('/predict', json={'fixtures': [{'home': 'Nobody', 'away': 'Team 2'}]})).status
+        ]
+        results['errors'] = statuses == [400, 400, 400] and server.counts['errors'] == 3
+
+        # Reload: a new artifact is picked up, and a team it dropped is a 400 from then on.
+        ModelArtifact(teams[:5], 1.2, 0.1, np.ones(5), np.ones(5), data_hash='second').save(path)
+        os.utime(path, ns=(time.time_ns(), server.model_mtime + 1))
+        await asyncio.sleep(0.3)
+        health = await (await client.get('/health')).json()
+        removed = await client.post('/predict', json={'fixtures': [{'home': 'Team 6', 'away': 'Team 1'}]})
+        results['reload'] = health['model'] == 'second' and health['teams'] == 5 and removed.status == 400
+
+        # A request queued before the reload fails with UnknownTeams instead of an error in the batch.
+        future = asyncio.get_running_loop().create_future()
+        server.predict_batch([(['Team 6'], ['Team 1'], future)])
+        results['queued_reload'] = isinstance(future.exception(), UnknownTeams)
+    finally:
+        await client.close()
+    return results
+
+
+def check_server():
+    """
+    Checks batching, hot reload and the error responses against an in process server on synthetic artifacts.
+
+    :return: True if every check passes.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as folder:
+        results = asyncio.run(_check_server(folder))
+    for name, ok in results.items():
+        print(f"{name:<14} {'ok' if ok else 'FAILED'}")
+    return all(results.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Match prediction server.")
+    parser.add_argument('--model', default='model.tsm', help="Model artifact to serve, reloaded when it changes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=512)
+    parser.add_argument('--max-wait', type=float, default=0.002, help="Seconds to wait for a batch to fill up.")
+    parser.add_argument('--check', action='store_true', help="Run the localhost checks and exit.")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_server() else 1)
+
+    server = PredictionServer(args.model, max_batch=args.max_batch, max_wait=args.max_wait)
+    web.run_app(server.app(), host=args.host, port=args.port)
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def fixture_rates(fixtures, parameters):
+    """
+    Expected goals of every fixture under the fitted model.
+
+    :param fixtures: DataFrame with columns H and A.
+    :param parameters: [gamma, rho, {team: {'a', 'b'}}] as returned by TeamStrength.maximize.
+    :return: (lamb, mu) arrays, expected home and away goals.
+    """
+    gamma = parameters[0]
+    team_parameters = parameters[2]
+
+    a = {team: team_parameters[team]['a'] for team in team_parameters}
+    b = {team: team_parameters[team]['b'] for team in team_parameters}
+
+    home = fixtures['H'].values
+    away = fixtures['A'].values
+    lamb = np.array([a[h] * b[aw] * gamma for h, aw in zip(home, away)], dtype=float)
+    mu = np.array([a[aw] * b[h] for h, aw in zip(home, away)], dtype=float)
+    return lamb, mu
+
+
+def draw_uniforms(n_sims, n_fixtures, seed=None):
+    """
+    Random numbers behind a simulation, shape (n_sims, n_fixtures, 2). Keeping these fixed and changing only the
+    rates gives common random numbers, so two simulations differ only where the rates differ.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.random((n_sims, n_fixtures, 2))
+
+
+def poisson_cdf_table(rates, max_goals=15):
+    """
+    :return: Poisson CDF at 0..max_goals goals for every rate, shape (len(rates), max_goals + 1).
+    """
+    return stats.poisson.cdf(np.arange(max_goals + 1)[np.newaxis, :], np.asarray(rates)[:, np.newaxis])
+
+
+def simulate_goals(lamb, mu, uniforms, max_goals=15):
+    """
+    Inverse-CDF Poisson draws of home and away goals for every simulation and fixture, by counting how many CDF
+    values of the fixture's table the random number exceeds. Goals are capped at max_goals.
+
+    :return: (home_goals, away_goals), both shape (n_sims, n_fixtures).
+    """
+    home_cdf = poisson_cdf_table(lamb, max_goals)[:, :max_goals]
+    away_cdf = poisson_cdf_table(mu, max_goals)[:, :max_goals]
+    home_goals = np.empty(uniforms.shape[1::-1], dtype=int)
+    away_goals = np.empty(uniforms.shape[1::-1], dtype=int)
+    # The count of CDF values below the random number is a binary search in the fixture's (sorted) table.
+    for f in range(uniforms.shape[1]):
+        home_goals[f] = np.searchsorted(home_cdf[f], uniforms[:, f, 0])
+        away_goals[f] = np.searchsorted(away_cdf[f], uniforms[:, f, 1])
+    return home_goals.T, away_goals.T
+
+
+def fixture_points(home_goals, away_goals):
+    """
+    :return: (home_points, away_points) for simulated results.
+    """
+    home_points = np.where(home_goals > away_goals, 3, np.where(home_goals == away_goals, 1, 0))
+    away_points = np.where(away_goals > home_goals, 3, np.where(home_goals == away_goals, 1, 0))
+    return home_points, away_points
+
+
+def simulate_season(fixtures, parameters, n_sims=10000, seed=None, base_points=None, uniforms=None):
+    """
+    Monte Carlo simulation of the remaining fixtures of a season.
+
+    :param fixtures: DataFrame with columns H and A, the fixtures left to play.
+    :param parameters: [gamma, rho, {team: {'a', 'b'}}] as returned by TeamStrength.maximize.
+    :param n_sims: Number of simulated seasons.
+    :param seed: Seed for the random numbers.
+    :param base_points: Dict of points already won per team.
+    :param uniforms: Precomputed random numbers from draw_uniforms, overrides n_sims and seed.
+    :return: (teams, points) where points has shape (n_sims, n_teams).
+    """
+    teams = sorted(set(fixtures['H']) | set(fixtures['A']))
+    index = {team: i for i, team in enumerate(teams)}
+    home = np.array([index[team] for team in fixtures['H']], dtype=int)
+    away = np.array([index[team] for team in fixtures['A']], dtype=int)
+
+    lamb, mu = fixture_rates(fixtures, parameters)
+    if uniforms is None:
+        uniforms = draw_uniforms(n_sims, len(fixtures), seed)
+
+    home_points, away_points = fixture_points(*simulate_goals(lamb, mu, uniforms))
+
+    points = np.zeros((uniforms.shape[0], len(teams)))
+    if base_points is not None:
+        points += np.array([base_points.get(team, 0) for team in teams], dtype=float)
+    # Scatter every fixture's points onto its two teams, for all simulations at once.
+    np.add.at(points.T, home, home_points.T)
+    np.add.at(points.T, away, away_points.T)
+    return teams, points
+
+
+def season_table(teams, points):
+    """
+    Summarises simulated seasons into a predicted final table.
+
+    :return: DataFrame with expected points, title probability and average position per team.
+    """
+    # Rank 1 is the most points, ties are broken by team order.
+    positions = np.argsort(np.argsort(-points, axis=1, kind='stable'), axis=1) + 1
+    table = pd.DataFrame({
+        'Team': teams,
+        'Points': points.mean(axis=0),
+        'Title': (positions == 1).mean(axis=0),
+        'Position': positions.mean(axis=0)
+    })
+    return table.sort_values('Points', ascending=False).reset_index(drop=True)
@@ -4,6 +4,11 @@ from scipy import stats
 import pandas as pd
 from datetime import datetime
 import time
+import cProfile
+import pstats
+import tracemalloc
+
+import Kernels
 
 
 def tau(x, y, lamb, mu, rho):
@@ -41,11 +46,141 @@ def decay(md, t=0.0065):
     return np.exp(-t * ((datetime.today() - match_date).days / 3.5))
 
 
+def decay_weights(dates, t=0.0065, today=None):
+    """
+    Vectorized decay() for a whole column of dates.
+
+    :param dates: Sequence of "%Y-%m-%d" dates.
+    :param t: Decay rate.
+    :param today: Date the weights are relative to, defaults to now like decay().
+    :return: Array of weights.
+    """
+    today = pd.Timestamp(datetime.today() if today is None else today)
+    days = (today - pd.to_datetime(pd.Series(dates).values)).days
+    return np.exp(-t * (np.asarray(days, dtype=float) / 3.5))
+
+
+def encode_matches(match_data, teams=None, t=0.0065, today=None):
+    """
+    Encodes match data as flat arrays, with teams replaced by their index in teams.
+
+    :param match_data: DataFrame with columns Date, H, A, xG and xGA.
+    :param teams: Team order, defaults to the sorted teams of the data.
+    :param t: Decay rate.
+    :param today: Date the decay weights are relative to, defaults to now.
+    :return: Dict with teams, home, away (index arrays), x, y (xG arrays) and w (decay weights, times the Weight
+             column if the data has one, see load_match_logs).
+    """
+    if teams is None:
+        teams = sorted(set(match_data['H']) | set(match_data['A']))
+    index = {team: i for i, team in enumerate(teams)}
+    return {
+        'teams': list(teams),
+        'home': match_data['H'].map(index).values.astype(np.int64),
+        'away': match_data['A'].map(index).values.astype(np.int64),
+        'x': match_data['xG'].values.astype(np.float64),
+        'y': match_data['xGA'].values.astype(np.float64),
+        'w': decay_weights(match_data['Date'], t, today) * (match_data['Weight'].values if 'Weight' in match_data
+                                                              else 1)
+    }
+
+
+def weight_cutoff(epsilon, t=0.0065, today=None):
+    """
+    :return: The date ("%Y-%m-%d") before which every match has a decay weight below epsilon.
+    """
+    today = pd.Timestamp(datetime.today() if today is None else today)
+    days = int(np.ceil(-np.log(epsilon) * 3.5 / t))
+    return (today - pd.Timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def load_match_logs(path, epsilon=1e-3, fold=False, t=0.0065, today=None, chunksize=100000, parameters=None):
+    """
+    Reads match logs in chunks, dropping or folding the matches whose decay weight is below epsilon, so the cost of
+    a fit is bounded by the effective window instead of the whole history.
+
+    Folding replaces all old matches between the same home and away team by one row carrying their summed weight
+    and weighted mean xG. The Poisson part of the likelihood is linear in x and y for fixed rates, so this is exact
+    for it; only tau, which applies to exact 0/1 scores, is lost. Dropping is approximate, the report says by how
+    much: exactly at parameters if given, otherwise estimated with every match at the league average rates.
+
+    :param path: CSV in the data.csv format.
+    :param epsilon: Weight below which matches are dropped or folded.
+    :param fold: Fold old matches instead of dropping them.
+    :param t: Decay rate.
+    :param today: Date the decay weights are relative to, defaults to now.
+    :param chunksize: Rows read at a time.
+    :param parameters: Parameters to measure the likelihood error at, in the format of maximize.
+    :return: (match_data, report) where report holds the kept, dropped and folded row counts, the dropped weight
+             and the likelihood error.
+    """
+    today = pd.Timestamp(datetime.today() if today is None else today).normalize()
+    cutoff = weight_cutoff(epsilon, t, today)
+
+    kept, old = [], []
+    # Every column is kept, e.g. Comp for JointModel and Season for Backtest.
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        # Dates are ISO strings, so the filter is a plain string comparison.
+        recent = chunk['Date'] >= cutoff
+        kept.append(chunk.loc[recent])
+        if (~recent).any():
+            old_chunk = chunk.loc[~recent].copy()
+            old_chunk['w'] = decay_weights(old_chunk['Date'], t, today)
+            if 'Weight' in chunk:
+                old_chunk['w'] *= old_chunk.pop('Weight').values
+            old.append(old_chunk)
+
+    match_data = pd.concat(kept, ignore_index=True)
+    old = pd.concat(old, ignore_index=True) if old else pd.DataFrame(columns=['Date', 'H', 'A', 'xG', 'xGA', 'w'])
+    report = {'kept': len(match_data), 'old': len(old), 'cutoff': cutoff, 'old_weight': float(old['w'].sum()),
+              'kept_weight': float(encode_matches(match_data, t=t, today=today)['w'].sum()) if len(match_data) else 0.0}
+
+    if fold and len(old):
+        old['wx'], old['wy'] = old['w'] * old['xG'], old['w'] * old['xGA']
+        # Matches of different competitions are never folded together, other columns (e.g. Season) take the value
+        # of the most recent folded match. Goals do not fold, so HG and AG are left empty.
+        keys = ['H', 'A'] + (['Comp'] if 'Comp' in old else [])
+        extra = [column for column in old if column not in keys + ['Date', 'xG', 'xGA', 'HG', 'AG', 'w', 'wx', 'wy']]
+        groups = old.sort_values('Date', kind='stable').groupby(keys, as_index=False)
+        folded = groups[['w', 'wx', 'wy']].sum().merge(groups[extra].last(), on=keys) if extra else \
+            groups[['w', 'wx', 'wy']].sum()
+        # Dated today, where decay is 1, so Weight is the total weight of the folded matches.
+        folded = folded.assign(Date=today.strftime("%Y-%m-%d"), xG=folded['wx'] / folded['w'],
+                               xGA=folded['wy'] / folded['w'], Weight=folded['w'])
+        folded = folded[['Date'] + keys + ['xG', 'xGA', 'Weight'] + extra]
+        if 'Weight' not in match_data:
+            match_data['Weight'] = 1.0
+        match_data = pd.concat([match_data, folded], ignore_index=True)
+        report['folded_rows'] = len(folded)
+        report['ll_error'] = 0.0
+        report['tau_rows_lost'] = int((((old['xG'] == 0) | (old['xG'] == 1)) &
+                                       ((old['xGA'] == 0) | (old['xGA'] == 1))).sum())
+    elif len(old):
+        if parameters is not None:
+            # Teams that only appear in old matches (e.g. relegated since) get the average strength.
+            teams = list(dict.fromkeys(list(parameters[2]) + list(old['H']) + list(old['A'])))
+            mean_a = np.mean([parameters[2][team]['a'] for team in parameters[2]])
+            mean_b = np.mean([parameters[2][team]['b'] for team in parameters[2]])
+            a = np.array([parameters[2][team]['a'] if team in parameters[2] else mean_a for team in teams])
+            b = np.array([parameters[2][team]['b'] if team in parameters[2] else mean_b for team in teams])
+            old_data = encode_matches(old, teams=teams, t=t, today=today)
+            report['ll_error'] = abs(Kernels.get_kernel()(old_data['home'], old_data['away'], old_data['x'],
+                                                          old_data['y'], old['w'].values, float(parameters[0]),
+                                                          float(parameters[1]), a, b, np.empty_like(a),
+                                                          np.empty_like(b))[0])
+        else:
+            lamb, mu = match_data['xG'].mean(), match_data['xGA'].mean()
+            ll = old['xG'] * np.log(lamb) - lamb + old['xGA'] * np.log(mu) - mu
+            report['ll_error'] = float((old['w'] * ll).abs().sum())
+            report['ll_error_estimated'] = True
+    return match_data, report
+
+
 def match_log_likelihood(x, y, ai, aj, bi, bj, gamma, rho, match_date):
     lamb = ai*bj*gamma
     mu = aj*bi
 
-    return decay(match_date)*(np.log(tau(x, y, lamb, mu, rho)) - lamb + x*np.log(lamb) - mu + np.log(mu))
+    return decay(match_date)*(np.log(tau(x, y, lamb, mu, rho)) - lamb + x*np.log(lamb) - mu + y*np.log(mu))
 
 
 def log_likelihood(match_data, parameters):
@@ -222,13 +357,30 @@ def find_gradient_vector(match_data, parameters):
     return gradient_vector
 
 
-def maximize(match_data, max_steps=300, learning_rate=0.01):
+def gradient_norm(gradient_vector):
+    """
+    :return: Euclidean norm of a gradient vector as returned by find_gradient_vector.
+    """
+    squares = gradient_vector[0]**2 + gradient_vector[1]**2
+    for team in gradient_vector[2]:
+        squares += gradient_vector[2][team]['pd_a']**2 + gradient_vector[2][team]['pd_b']**2
+    return np.sqrt(squares)
+
+
+def maximize(match_data, max_steps=300, learning_rate=0.01, callback=None, backend='auto', initial=None, today=None):
     """
     This method aims to maximize the log likelihood function and give us the parameters that best fit our Po-model.
 
     :param match_data: The data we want to maximize our log likelihood  function from.
     :param max_steps: Maximum steps we take in our gradient ascent.
     :param learning_rate: Pretty much step size.
+    :param callback: Called after every step with a dict of metrics: step, seconds (wall time of the step),
+                     log_likelihood (after the step), grad_norm, step_size and parameters. Returning True stops the
+                     ascent early. The metrics are only computed when a callback is given.
+    :param backend: Likelihood/gradient kernel, see Kernels.get_kernel.
+    :param initial: Parameters to start from (warm start), in the format this returns. Teams missing from it start
+                    at 1 like in a cold start.
+    :param today: Date the decay weights are relative to, defaults to now.
     :return:
     """
     """
@@ -242,36 +394,249 @@ def maximize(match_data, max_steps=300, learning_rate=0.01):
                 param += learning_rate*partial_derivative of that param
             steps += 1
         """
-    # Initializing the parameters
-    parameters = [1, 0.1, {}]
-    for team in match_data['H']:
-        parameters[2][team] = {'a': 1, 'b': 1}
-    for team in match_data['A']:
-        parameters[2][team] = {'a': 1, 'b': 1}
+    # Initializing the parameters, teams in the order they first appear as home and then away team.
+    teams = list(dict.fromkeys(list(match_data['H']) + list(match_data['A'])))
+    data = encode_matches(match_data, teams=teams, today=today)
+    kernel = Kernels.get_kernel(backend)
+
+    gamma, rho = 1.0, 0.1
+    a, b = np.ones(len(teams)), np.ones(len(teams))
+    if initial is not None:
+        gamma, rho = float(initial[0]), float(initial[1])
+        for i, team in enumerate(teams):
+            if team in initial[2]:
+                a[i], b[i] = initial[2][team]['a'], initial[2][team]['b']
+    grad_a, grad_b = np.empty_like(a), np.empty_like(b)
 
     step_count = 0
     while step_count < max_steps:
-        grad_vector = find_gradient_vector(match_data, parameters)
-
-        # parameters += learning_rate * grad_vector
-        parameters[0] += learning_rate * grad_vector[0]
-        parameters[1] += learning_rate * grad_vector[1]
+        if callback is not None:
+            start = time.perf_counter()
 
-        for team in grad_vector[2]:
-            parameters[2][team]['a'] += learning_rate * grad_vector[2][team]['pd_a']
-            parameters[2][team]['b'] += learning_rate * grad_vector[2][team]['pd_b']
+        # The kernel returns the same gradient as find_gradient_vector, whose rho partial is zero.
+        grad_gamma = kernel(data['home'], data['away'], data['x'], data['y'], data['w'], gamma, rho, a, b,
+                            grad_a, grad_b)[1]
 
+        # parameters += learning_rate * grad_vector
+        gamma += learning_rate * grad_gamma
+        a += learning_rate * grad_a
+        b += learning_rate * grad_b
 
         #if grad < epsilon
             #break
 
         step_count += 1
-    return parameters
 
+        if callback is not None:
+            grad_norm = np.sqrt(grad_gamma**2 + grad_a @ grad_a + grad_b @ grad_b)
+            seconds = time.perf_counter() - start
+            log_l = kernel(data['home'], data['away'], data['x'], data['y'], data['w'], gamma, rho, a, b,
+                           np.empty_like(a), np.empty_like(b))[0]
+            metrics = {
+                'step': step_count,
+                'seconds': seconds,
+                'log_likelihood': log_l,
+                'grad_norm': grad_norm,
+                'step_size': learning_rate * grad_norm,
+                'parameters': [gamma, rho, {team: {'a': a[i], 'b': b[i]} for i, team in enumerate(teams)}]
+            }
+            if callback(metrics):
+                break
+
+    return [gamma, rho, {team: {'a': float(a[i]), 'b': float(b[i])} for i, team in enumerate(teams)}]
+
+
+def _log_tau_derivatives(x, y, lamb, mu, rho):
+    """
+    First and second partial derivatives of log(tau) with respect to (lamb, mu, rho), per match.
+
+    :return: (d, dd) with shapes (n, 3) and (n, 3, 3), zero where the score is not low enough for tau to apply.
+    """
+    n = len(x)
+    d, dd = np.zeros((n, 3)), np.zeros((n, 3, 3))
+
+    k = (x == 0) & (y == 0)
+    t = 1 - lamb[k] * mu[k] * rho
+    d[k] = np.stack([-mu[k] * rho, -lamb[k] * rho, -lamb[k] * mu[k]], axis=1) / t[:, None]
+    dd[k] = -np.einsum('ki,kj->kij', d[k], d[k])
+    # d(log tau)/d(lamb) d(mu) etc. also get the second derivative of tau itself, tau + lamb * mu * rho = 1.
+    dd[k, 0, 1] = dd[k, 1, 0] = -rho / t**2
+    dd[k, 0, 2] = dd[k, 2, 0] = -mu[k] / t**2
+    dd[k, 1, 2] = dd[k, 2, 1] = -lamb[k] / t**2
+
+    for k, rate, slot in (((x == 0) & (y == 1), lamb, 0), ((x == 1) & (y == 0), mu, 1)):
+        t = 1 + rate[k] * rho
+        d[k, slot], d[k, 2] = rho / t, rate[k] / t
+        dd[k, slot, slot], dd[k, 2, 2] = -rho**2 / t**2, -rate[k]**2 / t**2
+        dd[k, slot, 2] = dd[k, 2, slot] = 1 / t**2
+
+    k = (x == 1) & (y == 1)
+    d[k, 2] = -1 / (1 - rho)
+    dd[k, 2, 2] = -1 / (1 - rho)**2
+    return d, dd
+
+
+def information_matrix(data, gamma, rho, a, b):
+    """
+    Observed information (minus the Hessian of the decayed log likelihood, tau included) over the parameter vector
+    [gamma, rho, a..., b...], with a and b in the team order of data.
+
+    Every match only touches gamma, rho and four team parameters, so its 6x6 block is computed for all matches at
+    once and scatter-added into the full matrix.
+
+    :param data: Encoded matches, see encode_matches.
+    :return: Array of shape (2 + 2n, 2 + 2n) for n teams.
+    """
+    home, away, x, y, w = data['home'], data['away'], data['x'], data['y'], data['w']
+    n = len(a)
+    ai, aj, bi, bj = a[home], a[away], b[home], b[away]
+    lamb = ai * bj * gamma
+    mu = aj * bi
+
+    # Derivatives of the match log likelihood with respect to (lamb, mu, rho).
+    d, dd = _log_tau_derivatives(x, y, lamb, mu, rho)
+    d[:, 0] += x / lamb - 1
+    d[:, 1] += y / mu - 1
+    dd[:, 0, 0] -= x / lamb**2
+    dd[:, 1, 1] -= y / mu**2
+
+    # Local parameters of a match: gamma, rho, a_i, b_j, a_j, b_i. J is the Jacobian of (lamb, mu, rho) in them.
+    m = len(x)
+    J = np.zeros((m, 3, 6))
+    J[:, 0, 0], J[:, 0, 2], J[:, 0, 3] = ai * bj, bj * gamma, ai * gamma
+    J[:, 1, 4], J[:, 1, 5] = bi, aj
+    J[:, 2, 1] = 1
+    hessian = np.einsum('kci,kcd,kdj->kij', J, dd, J)
+
+    # Second derivatives of lamb and mu themselves, weighted by the first derivatives of the likelihood.
+    for (p, q), value in (((0, 2), bj), ((0, 3), ai), ((2, 3), gamma)):
+        hessian[:, p, q] += d[:, 0] * value
+        hessian[:, q, p] += d[:, 0] * value
+    hessian[:, 4, 5] += d[:, 1]
+    hessian[:, 5, 4] += d[:, 1]
+
+    index = np.stack([np.zeros(m, dtype=np.int64), np.ones(m, dtype=np.int64), 2 + home, 2 + n + away, 2 + away,
+                      2 + n + home], axis=1)
+    information = np.zeros((2 + 2 * n, 2 + 2 * n))
+    np.add.at(information, (index[:, :, None], index[:, None, :]), -w[:, None, None] * hessian)
+    return information
+
+
+def standard_errors(match_data, parameters, t=0.0065, today=None):
+    """
+    Standard errors and covariance of fitted parameters from the observed information at the fit, at about the cost
+    of one gradient evaluation instead of a bootstrap.
+
+    The likelihood only depends on products a_i * b_j, so scaling every a up and every b down by the same factor
+    leaves it unchanged and the information matrix is singular. It is inverted under the constraint that the mean
+    of a stays fixed, via the bordered matrix [[I, c], [c', 0]]. Parameters with no information, rho when no match
+    has a low enough score for tau to apply, are left out and get nan.
+
+    :param match_data: The data the parameters were fitted on.
+    :param parameters: Fitted parameters, in the format maximize returns.
+    :param t: Decay rate.
+    :param today: Date the decay weights are relative to, as in the fit.
+    :return: (errors, covariance), errors in the format of parameters, covariance a DataFrame indexed by
+             ('gamma', ''), ('rho', ''), ('a', team) and ('b', team).
+    """
+    teams = list(parameters[2])
+    data = encode_matches(match_data, teams=teams, t=t, today=today)
+    a = np.array([parameters[2][team]['a'] for team in teams], dtype=np.float64)
+    b = np.array([parameters[2][team]['b'] for team in teams], dtype=np.float64)
+    n = len(teams)
+
+    information = information_matrix(data, float(parameters[0]), float(parameters[1]), a, b)
+    keep = np.flatnonzero(np.abs(information).sum(axis=1) > 0)
+
+    constraint = np.zeros(2 + 2 * n)
+    constraint[2:2 + n] = 1
+    size = len(keep)
+    bordered = np.zeros((size + 1, size + 1))
+    bordered[:size, :size] = information[np.ix_(keep, keep)]
+    bordered[:size, size] = bordered[size, :size] = constraint[keep]
+
+    covariance = np.full((2 + 2 * n, 2 + 2 * n), np.nan)
+    covariance[np.ix_(keep, keep)] = np.linalg.inv(bordered)[:size, :size]
+    se = np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+    errors = [se[0], se[1], {team: {'a': se[2 + i], 'b': se[2 + n + i]} for i, team in enumerate(teams)}]
+    labels = pd.MultiIndex.from_tuples([('gamma', ''), ('rho', '')] + [('a', team) for team in teams]
+                                       + [('b', team) for team in teams])
+    return errors, pd.DataFrame(covariance, index=labels, columns=labels)
 
-match_logs = pd.read_csv('data.csv')
-df = pd.DataFrame(match_logs)
-print(match_logs.sort_values('Date', ascending=False))
 
-result = maximize(df)
-print(result)
+class FitRecorder:
+    """
+    Callback for maximize that keeps the metrics of every step, and optionally stops the ascent once the gradient
+    is small or the log likelihood stops improving.
+    """
+    def __init__(self, grad_tol=None, ll_tol=None, verbose=False):
+        """
+        :param grad_tol: Stop when the gradient norm falls below this.
+        :param ll_tol: Stop when a step improves the log likelihood by less than this.
+        :param verbose: Print the metrics of every step.
+        """
+        self.grad_tol = grad_tol
+        self.ll_tol = ll_tol
+        self.verbose = verbose
+        self.history = []
+
+    def __call__(self, metrics):
+        previous = self.history[-1] if self.history else None
+        self.history.append({key: value for key, value in metrics.items() if key != 'parameters'})
+
+        if self.verbose:
+            print(f"step {metrics['step']:4d}  log(L) {metrics['log_likelihood']:12.4f}  "
+                  f"|grad| {metrics['grad_norm']:10.4f}  {metrics['seconds'] * 1000:8.1f} ms")
+
+        if self.grad_tol is not None and metrics['grad_norm'] < self.grad_tol:
+            return True
+        if self.ll_tol is not None and previous is not None:
+            return metrics['log_likelihood'] - previous['log_likelihood'] < self.ll_tol
+        return False
+
+    def to_frame(self):
+        return pd.DataFrame(self.history)
+
+
+def profile_fit(match_data, cprofile=True, memory=False, **kwargs):
+    """
+    Runs maximize under cProfile and/or tracemalloc.
+
+    :param match_data: The data we want to maximize our log likelihood function from.
+    :param cprofile: Capture a cProfile of the fit.
+    :param memory: Capture the peak traced memory and the largest allocation sites.
+    :param kwargs: Passed on to maximize.
+    :return: (parameters, report) where report may hold 'stats' (pstats.Stats), 'peak_memory' (bytes) and
+             'top_allocations' (tracemalloc statistics).
+    """
+    report = {}
+    profiler = cProfile.Profile() if cprofile else None
+
+    if memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        parameters = maximize(match_data, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            report['stats'] = pstats.Stats(profiler).sort_stats('cumulative')
+        if memory:
+            report['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            report['top_allocations'] = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+    return parameters, report
+
+
+if __name__ == '__main__':
+    # Matches with a decay weight below 1e-3 are folded into one row per fixture, the Poisson part of the likelihood
+    # is unchanged by this.
+    match_logs, load_report = load_match_logs('data.csv', fold=True)
+    print(load_report)
+    df = pd.DataFrame(match_logs)
+    print(match_logs.sort_values('Date', ascending=False))
+
+    result = maximize(df)
+    print(result)
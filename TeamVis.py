@@ -1,10 +1,13 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from DataScraper import get_stats_table
-import requests
-from bs4 import BeautifulSoup as soup
+from DataScraper import get_stats_table, fetch_page
 from FootballStructs import Team, League
+from ModelArtifact import ModelArtifact
 
 
 TEAM_COLORS = {'Newcastle Utd': ('w', 'black'),
@@ -29,74 +32,115 @@ TEAM_COLORS = {'Newcastle Utd': ('w', 'black'),
                'Manchester City': ('#6CABDD', '#6CABDD')
                }
 
+# Used for teams outside the Premier League, which have no entry in TEAM_COLORS.
+DEFAULT_COLORS = ('w', '#808080')
+
+ASPECTS = ('o', 'a', 'd', 'wr')
+
+# Error bars span +- this many standard errors, i.e. a 95% confidence interval.
+CI_Z = 1.96
+
 
 class Plot:
-    def __init__(self, teams):
+    def __init__(self, teams, league='Premier League', abbrev='PL', intervals=False):
         self.teams = teams
+        self.league = league
+        self.abbrev = abbrev
+        self.intervals = intervals
+
+    def rates(self):
+        """
+        :return: Arrays of attack and defence rates for self.teams, in the same order.
+        """
+        attack = np.asarray([team.attack_rate for team in self.teams], dtype=float).ravel()
+        defence = np.asarray([team.defence_rate for team in self.teams], dtype=float).ravel()
+        return attack, defence
+
+    def errors(self):
+        """
+        :return: Arrays of the standard errors of the attack and defence rates, or None if intervals are off or the
+                 ratings have no standard errors.
+        """
+        if not self.intervals or any(team.attack_error is None for team in self.teams):
+            return None
+        attack = np.asarray([team.attack_error for team in self.teams], dtype=float).ravel()
+        defence = np.asarray([team.defence_error for team in self.teams], dtype=float).ravel()
+        return attack, defence
 
     def standard(self, aspect='o'):
+        attack, defence = self.rates()
         if aspect == 'a':
-            self.teams = sorted(self.teams, key=lambda team: team.attack_rate)
-            stat = {self.teams[i].name: (self.teams[i].attack_rate, i+1) for i in range(len(self.teams))}
+            values = attack
         elif aspect == 'd':
-            self.teams = sorted(self.teams, key=lambda team: team.defence_rate, reverse=True)
-            stat = {self.teams[i].name: (self.teams[i].defence_rate, i + 1) for i in range(len(self.teams))}
+            values = -defence
         else:
-            self.teams = sorted(self.teams, key=lambda team: team.attack_rate - team.defence_rate)
-            stat = {self.teams[i].name: (self.teams[i].attack_rate - self.teams[i].defence_rate, i + 1) for i in range(len(self.teams))}
+            values = attack - defence
+        # Sorting once by index instead of re-sorting the team objects on every call.
+        order = np.argsort(values, kind='stable')
+        values = (defence if aspect == 'd' else values)[order]
+        teams = [self.teams[i] for i in order]
+        stat = {teams[i].name: (values[i], i + 1) for i in range(len(teams))}
+
+        errors = self.errors()
+        if errors is not None:
+            # The covariance of a team's attack and defence is ignored for the overall error.
+            errors = errors[0] if aspect == 'a' else errors[1] if aspect == 'd' else np.hypot(*errors)
+            errors = errors[order]
 
         # Giving the plot proper size
         plt.figure(figsize=(11, 7))
 
         # Setting correct ticks on x-axis
-        plt.xticks(np.arange(np.floor(min([val[0] for val in list(stat.values())]) * 10) / 10, np.ceil(max([val[0] for val in list(stat.values())]) * 10) / 10 + 0.1,
+        plt.xticks(np.arange(np.floor(values.min() * 10) / 10, np.ceil(values.max() * 10) / 10 + 0.1,
                              0.2 if aspect == 'o' else 0.1))
 
         # Making a nice grid pattern
         plt.grid(axis='both')
 
         # Plotting the values
+        if errors is not None:
+            plt.errorbar(values, np.arange(1, len(teams) + 1), xerr=CI_Z * errors, fmt='none', ecolor='grey',
+                         capsize=3, zorder=1)
         self.plot(stat, ms=16)
 
-        plt.yticks([(i+1) for i in range(len(self.teams))], [team.short for team in self.teams])
+        plt.yticks([(i+1) for i in range(len(teams))], [team.short for team in teams])
 
         # Adding a bit of text
         if aspect == 'o':
-            plt.title(label="Premier League Overall Team Strength Estimates", loc="left", fontsize=16, color='black')
-            plt.xlabel("Predicted goal difference against average PL opponent")
+            plt.title(label=f"{self.league} Overall Team Strength Estimates", loc="left", fontsize=16, color='black')
+            plt.xlabel(f"Predicted goal difference against average {self.abbrev} opponent")
         elif aspect == 'a':
-            plt.title(label="Premier League Attacking Strength Estimates", loc="left", fontsize=16, color='black')
-            plt.xlabel("Predicted goals scored against average PL opponent")
+            plt.title(label=f"{self.league} Attacking Strength Estimates", loc="left", fontsize=16, color='black')
+            plt.xlabel(f"Predicted goals scored against average {self.abbrev} opponent")
         elif aspect == 'd':
-            plt.title(label="Premier League Defensive Strength Estimates", loc="left", fontsize=16, color='black')
-            plt.xlabel("Predicted goals conceded against average PL opponent")
+            plt.title(label=f"{self.league} Defensive Strength Estimates", loc="left", fontsize=16, color='black')
+            plt.xlabel(f"Predicted goals conceded against average {self.abbrev} opponent")
 
     def wr_plot(self):
-        team_xy = {}
-        for team in self.teams:
-            team_xy[team.name] = (team.attack_rate, team.defence_rate)
+        attack, defence = self.rates()
+        team_xy = {team.name: (attack[i], defence[i]) for i, team in enumerate(self.teams)}
 
         plt.figure(figsize=(8, 7))
 
         plt.grid(axis='both')
 
+        errors = self.errors()
+        if errors is not None:
+            plt.errorbar(attack, defence, xerr=CI_Z * errors[0], yerr=CI_Z * errors[1], fmt='none', ecolor='grey',
+                         capsize=3, zorder=1)
         self.plot(team_xy, ms=20)
 
         self.fill_diags()
 
-        plt.title(label="Premier League Strength Estimates", loc="left", fontsize=16, color='black')
-        plt.xlabel("Predicted goals scored against average PL opponent")
-        plt.ylabel("Predicted goals conceded against average PL opponent")
+        plt.title(label=f"{self.league} Strength Estimates", loc="left", fontsize=16, color='black')
+        plt.xlabel(f"Predicted goals scored against average {self.abbrev} opponent")
+        plt.ylabel(f"Predicted goals conceded against average {self.abbrev} opponent")
         plt.gca().invert_yaxis()
 
     def fill_diags(self):
-        self.teams = sorted(self.teams, key=lambda team: team.attack_rate)
-        min_x = self.teams[0].attack_rate[0]
-        max_x = self.teams[len(self.teams) - 1].attack_rate[0]
-
-        self.teams = sorted(self.teams, key=lambda team: team.defence_rate)
-        min_y = self.teams[0].defence_rate[0]
-        max_y = self.teams[len(self.teams) - 1].defence_rate[0]
+        attack, defence = self.rates()
+        min_x, max_x = attack.min(), attack.max()
+        min_y, max_y = defence.min(), defence.max()
 
         k = -1
         A, B, C, D = (min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)
@@ -133,12 +177,14 @@ class Plot:
         y = [0] + np.sin(np.linspace(2 * np.pi * r1, 2 * np.pi * r2, 10)).tolist()
         xy2 = list(zip(x, y))
 
-        for point in team_xy:
-            plt.plot(team_xy[point][0], team_xy[point][1], marker=xy1, ms=ms, linestyle='None', color='black',
-                     markerfacecolor=TEAM_COLORS[point][0])
-        for point in team_xy:
-            plt.plot(team_xy[point][0], team_xy[point][1], marker=xy2, ms=ms, linestyle='None', color='black',
-                     markerfacecolor=TEAM_COLORS[point][1])
+        # One collection per half circle, with positions and face colours for all teams at once.
+        names = list(team_xy)
+        positions = np.asarray([team_xy[name] for name in names], dtype=float).reshape(len(names), 2)
+        colors = [TEAM_COLORS.get(name, DEFAULT_COLORS) for name in names]
+        plt.scatter(positions[:, 0], positions[:, 1], marker=xy1, s=ms**2, edgecolors='black',
+                    facecolors=[color[0] for color in colors], zorder=2)
+        plt.scatter(positions[:, 0], positions[:, 1], marker=xy2, s=ms**2, edgecolors='black',
+                    facecolors=[color[1] for color in colors], zorder=2)
 
 
 def expected_goals_against_average(bbar, a, hfa):
@@ -149,27 +195,23 @@ def expected_goals_conceded_against_average(b, abar, hfa):
     return b*abar*(hfa + 1)/2
 
 
-def main():
+def build_league(team_ratings, short_df, names=None):
+    """
+    Creates a League of Teams with their attack and defence rates set from the ratings table.
 
-    curr_season = "https://fbref.com/en/comps/9/Premier-League-Stats"
-
-    p = requests.get(curr_season)
-    p = soup(p.text, 'html.parser')
-    p = p.find(id='content')
-
-    league_table = get_stats_table("overall", p)
-    curr_teams = league_table[['Squad']].copy()
-    ts = pd.Series(curr_teams['Squad'].values, index=curr_teams['Squad'])
-    ts = ts.str.strip()
-
-    short_df = pd.read_csv('short_names.csv')
-
-    team_ratings = pd.read_csv('Team Ratings.csv')
-    team_ratings = pd.DataFrame(team_ratings)
+    :param team_ratings: DataFrame with columns Team, Attacking Strength, Defensive Strength and HFA, and optionally
+                         Attacking SE and Defensive SE, which are carried over to the standard errors of the rates.
+    :param short_df: DataFrame with columns Team and Short, teams missing from it get the first three letters.
+    :param names: Teams to include, defaults to every team in team_ratings.
+    :return: League
+    """
+    if names is None:
+        names = team_ratings['Team'].values
+    shorts = dict(zip(short_df['Team'], short_df['Short'])) if short_df is not None else {}
 
     teams = []
-    for team in ts.values:
-        short = short_df.loc[short_df['Team'] == team]['Short'].values[0]
+    for team in names:
+        short = shorts.get(team, team[:3].upper())
 
         team_rating = team_ratings.loc[team_ratings['Team'] == team]
         teams.append(Team(team, short, team_rating['Attacking Strength'].values[0], team_rating['Defensive Strength'].values[0]))
@@ -181,14 +223,105 @@ def main():
         team.set_attack_rate(expected_goals_against_average(league.get_league_average_defence(), team.a, league.hfa))
         team.set_defence_rate(expected_goals_conceded_against_average(team.b, league.get_league_average_attack(), league.hfa))
 
-    fig = Plot(teams)
+    if 'Attacking SE' in team_ratings and 'Defensive SE' in team_ratings:
+        errors = team_ratings.set_index('Team')[['Attacking SE', 'Defensive SE']]
+        for team in league.teams:
+            # The rates are linear in a and b, the uncertainty of the league averages and the HFA is left out.
+            team.set_rate_errors(
+                expected_goals_against_average(league.get_league_average_defence(), errors.loc[team.name, 'Attacking SE'], league.hfa),
+                expected_goals_conceded_against_average(errors.loc[team.name, 'Defensive SE'], league.get_league_average_attack(), league.hfa))
+    return league
+
+
+def render_job(job):
+    """
+    Renders all aspects for one league and date to image files, without showing them. Runs in a worker process.
+
+    :param job: Dict with keys league, date, ratings (csv path) or model (artifact path), and optionally abbrev,
+                short_names (csv path), out_dir, aspects, format and intervals (draw confidence intervals).
+    :return: List of written file paths.
+    """
+    plt.switch_backend('Agg')
+
+    if job.get('model'):
+        team_ratings = ModelArtifact.load(job['model']).ratings_table()
+    else:
+        team_ratings = pd.read_csv(job['ratings'])
+    short_df = pd.read_csv(job['short_names']) if job.get('short_names') else None
+    league = build_league(team_ratings, short_df)
+
+    out_dir = job.get('out_dir', 'charts')
+    os.makedirs(out_dir, exist_ok=True)
+    stem = f"{job['league']}_{job['date']}".replace(' ', '_')
+
+    paths = []
+    for aspect in job.get('aspects', ASPECTS):
+        fig = Plot(league.teams, league=job['league'], abbrev=job.get('abbrev', job['league']),
+                   intervals=job.get('intervals', False))
+        if aspect == 'wr':
+            fig.wr_plot()
+        else:
+            fig.standard(aspect=aspect)
+        path = os.path.join(out_dir, f"{stem}_{aspect}.{job.get('format', 'png')}")
+        plt.savefig(path, bbox_inches='tight')
+        plt.close('all')
+        paths.append(path)
+    return paths
+
+
+def export_charts(jobs, workers=None):
+    """
+    Renders the charts of many leagues and dates across a process pool.
+
+    :param jobs: List of job dicts, see render_job.
+    :param workers: Number of processes, defaults to the number of CPUs.
+    :return: List of written file paths.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [path for paths in pool.map(render_job, jobs) for path in paths]
+
+
+def main(model=None, intervals=False):
+
+    curr_season = "https://fbref.com/en/comps/9/Premier-League-Stats"
+
+    # Only the league table is parsed, not the whole page.
+    league_table = get_stats_table("overall", fetch_page(curr_season))
+    curr_teams = league_table[['Squad']].copy()
+    ts = pd.Series(curr_teams['Squad'].values, index=curr_teams['Squad'])
+    ts = ts.str.strip()
+
+    short_df = pd.read_csv('short_names.csv')
+
+    if model is not None:
+        team_ratings = ModelArtifact.load(model).ratings_table()
+    else:
+        team_ratings = pd.read_csv('Team Ratings.csv')
+        team_ratings = pd.DataFrame(team_ratings)
+
+    league = build_league(team_ratings, short_df, names=ts.values)
+
+    fig = Plot(league.teams, intervals=intervals)
     #fig.standard(aspect='o')
     fig.wr_plot()
     plt.show()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Team strength charts.")
+    parser.add_argument('--batch', help="JSON file with a list of chart jobs, rendered headless to image files.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes in batch mode.")
+    parser.add_argument('--model', help="Model artifact to plot, instead of Team Ratings.csv.")
+    parser.add_argument('--intervals', action='store_true',
+                        help="Draw 95%% confidence intervals, for ratings with standard errors.")
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch) as f:
+            written = export_charts(json.load(f), workers=args.workers)
+        print(f"Wrote {len(written)} charts")
+    else:
+        main(model=args.model, intervals=args.intervals)
 
 
 """
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import time
+import numpy as np
+import pandas as pd
+
+from Prediction import score_matrix, result_probabilities
+from Simulation import draw_uniforms, simulate_season, season_table
+
+
+class WhatIf:
+    """
+    Answers "what if team X's attack drops 10%" without rebuilding everything.
+
+    The baseline (expected goals of every fixture, the team x GW matrix of the FDR, the score distributions and a
+    season simulation) is computed once. A query only recomputes the fixtures that involve a changed team: their
+    cells in the matrix are corrected by the difference in expected goals, their score distributions are recomputed,
+    and they are re-simulated with the same random numbers as the baseline (common random numbers), so the simulated
+    points only change where the fixtures changed and the difference to the baseline carries no extra noise.
+    """
+    def __init__(self, parameters, fixtures, gws=None, n_sims=10000, seed=None, base_points=None, max_goals=10):
+        """
+        :param parameters: [gamma, rho, {team: {'a', 'b'}}] as returned by TeamStrength.maximize.
+        :param fixtures: DataFrame with columns H and A (and Date if gws is given), the fixtures left to play.
+        :param gws: List of gameweek deadline dates ("%Y-%m-%d") of the team x GW matrix, no matrix if None.
+        :param n_sims: Number of simulated seasons.
+        :param seed: Seed for the random numbers.
+        :param base_points: Dict of points already won per team.
+        :param max_goals: Largest number of goals per team in the score distributions.
+        """
+        self.teams = sorted(set(fixtures['H']) | set(fixtures['A']))
+        self.index = {team: i for i, team in enumerate(self.teams)}
+        self.fixtures = fixtures.reset_index(drop=True)
+        self.home = np.array([self.index[team] for team in fixtures['H']], dtype=int)
+        self.away = np.array([self.index[team] for team in fixtures['A']], dtype=int)
+        self.max_goals = max_goals
+
+        self.parameters = parameters
+        self.gamma, self.rho = float(parameters[0]), float(parameters[1])
+        self.a = np.array([parameters[2][team]['a'] for team in self.teams], dtype=float)
+        self.b = np.array([parameters[2][team]['b'] for team in self.teams], dtype=float)
+        self.lamb, self.mu = self.rates(self.a, self.b)
+
+        self.gws = gws
+        if gws is not None:
+            deadlines = pd.to_datetime(pd.Series(gws)).values
+            dates = pd.to_datetime(self.fixtures['Date']).values
+            # The last GW whose deadline is on or before the fixture date, like FDR.find_gw.
+            self.cols = np.maximum(np.searchsorted(deadlines, dates, side='right') - 1, 0)
+            shape = (len(self.teams), len(gws))
+            self.GS, self.GA, self.N = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=int)
+            self.add_to_matrix(self.GS, self.GA, np.arange(len(self.fixtures)), self.lamb, self.mu)
+            np.add.at(self.N, (self.home, self.cols), 1)
+            np.add.at(self.N, (self.away, self.cols), 1)
+
+        self.scores = score_matrix(self.lamb, self.mu, self.rho, max_goals)
+        self.probabilities = np.stack(result_probabilities(self.scores), axis=1)
+
+        self.uniforms = draw_uniforms(n_sims, len(self.fixtures), seed)
+        self.points = simulate_season(self.fixtures, parameters, base_points=base_points, uniforms=self.uniforms)[1]
+        self.table = season_table(self.teams, self.points)
+
+    def rates(self, a, b, fixtures=None):
+        """
+        :return: (lamb, mu) of the given fixture indices, all fixtures if None.
+        """
+        home = self.home if fixtures is None else self.home[fixtures]
+        away = self.away if fixtures is None else self.away[fixtures]
+        return a[home] * b[away] * self.gamma, a[away] * b[home]
+
+    def add_to_matrix(self, GS, GA, fixtures, lamb, mu):
+        """
+        Adds the expected goals of fixtures to both teams' cells: the home team scores lamb and concedes mu.
+        """
+        cols = self.cols[fixtures]
+        np.add.at(GS, (self.home[fixtures], cols), lamb)
+        np.add.at(GA, (self.home[fixtures], cols), mu)
+        np.add.at(GS, (self.away[fixtures], cols), mu)
+        np.add.at(GA, (self.away[fixtures], cols), lamb)
+
+    def query(self, overrides):
+        """
+        :param overrides: Dict of team to multipliers of its parameters, e.g. {'Arsenal': {'a': 0.9}} for an attack
+                          10% weaker. b is goals conceded, so {'b': 1.1} is a defence 10% worse.
+        :return: Dict with
+                 parameters: the overridden parameters, in the format of TeamStrength.maximize,
+                 fixtures: DataFrame of the affected fixtures, with expected goals and result probabilities before
+                           and after,
+                 GS, GA: the team x GW matrix (if gws were given),
+                 cells: (rows, cols) of the matrix cells that changed,
+                 points: simulated points, shape (n_sims, n_teams),
+                 table: the predicted final table, with the change in expected points and title probability.
+        """
+        a, b = self.a.copy(), self.b.copy()
+        for team, multipliers in overrides.items():
+            if team not in self.index:
+                raise ValueError(f"{team!r} has no fixtures left")
+            a[self.index[team]] *= multipliers.get('a', 1)
+            b[self.index[team]] *= multipliers.get('b', 1)
+
+        changed = np.array([self.index[team] for team in overrides], dtype=int)
+        affected = np.flatnonzero(np.isin(self.home, changed) | np.isin(self.away, changed))
+        lamb, mu = self.rates(a, b, affected)
+
+        result = {'parameters': [self.gamma, self.rho,
+                                 {team: {'a': a[i], 'b': b[i]} for i, team in enumerate(self.teams)}]}
+
+        if self.gws is not None:
+            GS, GA = self.GS.copy(), self.GA.copy()
+            self.add_to_matrix(GS, GA, affected, lamb - self.lamb[affected], mu - self.mu[affected])
+            result['GS'], result['GA'] = GS, GA
+            result['cells'] = (np.concatenate([self.home[affected], self.away[affected]]),
+                               np.concatenate([self.cols[affected], self.cols[affected]]))
+
+        probabilities = np.stack(result_probabilities(score_matrix(lamb, mu, self.rho, self.max_goals)), axis=1)
+        fixtures = self.fixtures.loc[affected].copy()
+        fixtures['home_xg'], fixtures['away_xg'] = self.lamb[affected], self.mu[affected]
+        fixtures['new_home_xg'], fixtures['new_away_xg'] = lamb, mu
+        for k, outcome in enumerate(('p_home', 'p_draw', 'p_away')):
+            fixtures[outcome] = self.probabilities[affected, k]
+            fixtures[f"new_{outcome}"] = probabilities[:, k]
+        result['fixtures'] = fixtures
+
+        # Only the affected fixtures are simulated again, before and after the override, on the baseline's random
+        # numbers. Their difference is the change in points.
+        uniforms = self.uniforms[:, affected]
+        teams, before = simulate_season(fixtures, self.parameters, uniforms=uniforms)
+        after = simulate_season(fixtures, result['parameters'], uniforms=uniforms)[1]
+        result['points'] = self.points.copy()
+        result['points'][:, [self.index[team] for team in teams]] += after - before
+
+        table = season_table(self.teams, result['points'])
+        baseline = self.table.set_index('Team')
+        table['Points change'] = table['Points'] - baseline.loc[table['Team'], 'Points'].values
+        table['Title change'] = table['Title'] - baseline.loc[table['Team'], 'Title'].values
+        result['table'] = table
+        return result
+
+
+def fixtures_frame(fixtures):
+    """
+    :param fixtures: Dict of fixtures keyed by team name, as returned by FDR.get_fixtures.
+    :return: DataFrame with columns Date, H and A, one row per fixture, with the team names of the ratings.
+    """
+    from FDR import translate_team_names
+
+    return pd.DataFrame([(fixture['date'], translate_team_names(team), translate_team_names(fixture['opponent']))
+                         for team, team_fixtures in fixtures.items() for fixture in team_fixtures if fixture['home']],
+                        columns=['Date', 'H', 'A'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Season and fixture outlook under overridden team ratings.")
+    parser.add_argument('team', help="Team whose ratings are overridden.")
+    parser.add_argument('--attack', type=float, default=1.0, help="Multiplier of the team's attack, e.g. 0.9.")
+    parser.add_argument('--defence', type=float, default=1.0,
+                        help="Multiplier of the team's goals conceded, e.g. 1.1 for a 10%% worse defence.")
+    parser.add_argument('--model', help="Model artifact to use, instead of Team Ratings.csv.")
+    parser.add_argument('--sims', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import FDR
+    from ModelArtifact import ModelArtifact
+
+    if args.model:
+        parameters = ModelArtifact.load(args.model).parameters()
+    else:
+        ratings = pd.read_csv('Team Ratings.csv')
+        parameters = [ratings['HFA'].values[0], 0.1,
+                      {team: {'a': a, 'b': b} for team, a, b in
+                       zip(ratings['Team'], ratings['Attacking Strength'], ratings['Defensive Strength'])}]
+    fixtures = fixtures_frame(FDR.get_fixtures())
+    gws = asyncio.run(FDR.main())[0]
+
+    start = time.perf_counter()
+    what_if = WhatIf(parameters, fixtures, gws=gws, n_sims=args.sims, seed=args.seed)
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = what_if.query({args.team: {'a': args.attack, 'b': args.defence}})
+    query_seconds = time.perf_counter() - start
+
+    print(result['fixtures'].to_string(index=False))
+    print(result['table'].to_string(index=False))
+    print(f"Baseline {baseline_seconds * 1000:.0f} ms, query {query_seconds * 1000:.1f} ms")